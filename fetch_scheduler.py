@@ -0,0 +1,157 @@
+"""
+This file contains the politeness scheduler used when fetching pages concurrently. It rate limits each host,
+retries throttled or failed downloads with jittered backoff, and stops an iteration's fetching at a deadline
+so a slow host cannot stall the whole iteration.
+"""
+
+# Environment Set Up
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from web_scraping import download_page, FetchError
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: tokens refill at rate per second up to burst, and every request takes one.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        """
+        Block until a token is available.
+
+        Input: optional time.monotonic() deadline
+        Output: True once a token is taken, False if the deadline would pass first
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class FetchScheduler:
+    """
+    Polite page fetching for AsyncFetcher.
+
+    Every host gets its own token bucket (rate_per_host requests per second, bursts of burst_per_host).
+    Downloads use connect/read timeouts, failures that may pass (timeouts, 429, 5xx) are retried up to
+    max_retries times with full-jitter exponential backoff (honouring Retry-After), and nothing is fetched
+    once the iteration deadline set by start_iteration() has passed.
+    """
+
+    def __init__(self, rate_per_host=1.0, burst_per_host=2, connect_timeout=5, read_timeout=15,
+                 max_retries=2, backoff_base=0.5, backoff_cap=8.0, iteration_deadline=60.0):
+        self.rate_per_host = rate_per_host
+        self.burst_per_host = burst_per_host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.iteration_deadline = iteration_deadline
+
+        self.deadline = None
+        self._buckets = defaultdict(lambda: TokenBucket(self.rate_per_host, self.burst_per_host))
+        self._buckets_lock = threading.Lock()
+
+        # Counters for the end of iteration report
+        self.retries = 0
+        self.failures = 0
+        self.deadline_skips = 0
+
+    def start_iteration(self):
+        """
+        Start the clock for a new iteration; fetching stops iteration_deadline seconds from now.
+
+        Input: N/A
+        Output: N/A
+        """
+        self.deadline = time.monotonic() + self.iteration_deadline
+
+    def _bucket(self, url):
+        with self._buckets_lock:
+            return self._buckets[urlparse(url).netloc]
+
+    def _backoff(self, attempt, retry_after):
+        """
+        Seconds to wait before the next attempt: full jitter over an exponentially growing window,
+        but never less than what the server asked for.
+
+        Input: number of the failed attempt (0 based), Retry-After seconds or None
+        Output: seconds to sleep
+        """
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_cap))
+        return delay
+
+    def fetch(self, url):
+        """
+        Fetch a page politely.
+
+        Input: URL
+        Output: HTML, or None if the page could not be fetched before the deadline
+        """
+        for attempt in range(self.max_retries + 1):
+            # Wait for this host's rate limit, unless that would run past the deadline
+            if not self._bucket(url).acquire(self.deadline):
+                self.deadline_skips += 1
+                return None
+
+            # Never wait on the server longer than the time left in the iteration
+            read_timeout = self.read_timeout
+            if self.deadline is not None:
+                remaining = self.deadline - time.monotonic()
+                if remaining <= 0:
+                    self.deadline_skips += 1
+                    return None
+                read_timeout = min(read_timeout, remaining)
+
+            try:
+                return download_page(url, timeout=(self.connect_timeout, read_timeout), deadline=self.deadline)
+            except FetchError as e:
+                if not e.retryable or attempt == self.max_retries:
+                    self.failures += 1
+                    return None
+
+                delay = self._backoff(attempt, e.retry_after)
+                if self.deadline is not None and time.monotonic() + delay > self.deadline:
+                    self.deadline_skips += 1
+                    return None
+                self.retries += 1
+                time.sleep(delay)
+            except Exception:
+                # Last resort: an unexpected error on one page must not end the whole batch of downloads
+                self.failures += 1
+                return None
+
+        return None
+
+    def report(self):
+        """
+        Summary of retries and dropped pages for the terminal.
+
+        Input: N/A
+        Output: string
+        """
+        return (f"Fetch scheduler: {self.retries} retries, {self.failures} failed pages, "
+                f"{self.deadline_skips} pages dropped at the deadline")
@@ -7,10 +7,16 @@ import requests
 import sys
 import string
 import re
+import os
+import traceback
 
 # Import all functions from other files for Annotation and relation extraction 
 from relation_extraction import *
 from web_scraping import *
+from web_cache import SearchCache
+from near_duplicates import SimHashIndex
+from fetch_scheduler import FetchScheduler
+from pipeline import Pipeline, Stage
 
 # Global variables from command line
 seed_query = ""
@@ -22,9 +28,48 @@ gemini_api_key = ""
 cx = ""
 extraction_type = 0
 
+# Optional command line settings: time every spaCy component on the first iteration's pages
+spacy_timings = False
+
 # Used urls
 seen_urls = set()
 
+# Fingerprints of annotated pages, used to skip near-duplicate pages across iterations
+duplicate_index = SimHashIndex(max_distance=3)
+
+# Concurrent fetch settings (total downloads in flight, downloads in flight per host)
+fetch_concurrency = 10
+fetch_per_host = 2
+
+# Pipeline settings: worker threads per stage and size of the queue in front of each stage
+text_workers = 2
+nlp_workers = 1
+extract_workers = 1
+
+# Most pages annotated by one batched spaCy call (pages already waiting in the queue are batched together)
+nlp_batch_pages = 10
+pipeline_queue_size = 8
+
+# Most pages whose SpanBERT candidate pairs are predicted together (pages already waiting are batched together)
+extract_batch_pages = 10
+
+# Number of pages of the current iteration reported so far
+pages_reported = 0
+
+# Politeness scheduler: per-host rate limits, timeouts, retries with backoff, and a deadline per iteration (seconds)
+fetch_scheduler = FetchScheduler(rate_per_host=1.0, burst_per_host=2, connect_timeout=5, read_timeout=15,
+                                 max_retries=2, iteration_deadline=60.0)
+
+# On-disk cache of downloaded pages (size budget in bytes, seconds before a page is revalidated)
+cache_dir = "./.cache"
+page_cache_bytes = 200 * 1024 * 1024
+page_cache_ttl = 24 * 60 * 60
+
+# Cache of search results (query -> urls) shared across runs
+search_cache = None
+search_cache_entries = 1000
+search_cache_ttl = 7 * 24 * 60 * 60
+
 # Used queries
 used_queries = set()
 
@@ -158,8 +203,16 @@ def search():
             "num": 10
     }
 
-    # Perform a Google search using the requests package
-    response = requests.get(url, params=params)
+    # Reuse the results of an earlier identical search if we have them
+    cache_key = None
+    if search_cache is not None:
+        cache_key = search_cache.make_key(seed_query, cx, params["num"])
+        cached_urls = search_cache.get(cache_key)
+        if cached_urls is not None:
+            return cached_urls
+
+    # Perform a Google search over the shared keep-alive session (web_scraping.py)
+    response = get_session().get(url, params=params, timeout=(connect_timeout, read_timeout))
     json = response.json()
 
     urls = [] # List of URLs found in the search results
@@ -168,10 +221,126 @@ def search():
             # Return only HTML results for user
             if ((result.get('fileFormat') is None) | ('fileFormat' not in json)):
                 urls.append(result['link'])
+
+       # Only successful searches are cached (errors such as an exceeded quota have no items)
+       if search_cache is not None:
+            search_cache.put(cache_key, urls)
     
     return urls
 
 
+def text_stage(page):
+    """
+    Pipeline stage: extract plain text from a fetched page and flag pages that need no annotation.
+
+    Input: page dictionary with url and html
+    Output: the page with its plain text, or a skip message if it could not be fetched or is a near-duplicate
+    """
+    #check if html is None (website not found i.e timeout)
+    if page["html"] is None:
+        page["skip"] = "Unable to fetch URL. Continuing."
+        return page
+
+    # extract plain text from html
+    page["text"], page["trimmed"] = extract_plain_text_trimmed(page.pop("html"))
+
+    # skip pages whose text is a near-duplicate (mirror, syndicated copy) of a page we already annotated;
+    # its relations are already in X
+    duplicate_of = duplicate_index.check_and_add(page["url"], page["text"])
+    if duplicate_of is not None:
+        page["skip"] = f"Near-duplicate of {duplicate_of}. Skipping annotation."
+
+    return page
+
+
+def nlp_stage(pages):
+    """
+    Pipeline stage: annotate the plain text of every page waiting in the queue with one batched spaCy call.
+
+    Input: list of page dictionaries with their plain text
+    Output: the pages, in the same order, with their spaCy docs
+    """
+    to_annotate = [page for page in pages if "skip" not in page]
+    for page, doc in zip(to_annotate, annotate_pages(page["text"] for page in to_annotate)):
+        page["doc"] = doc
+    return pages
+
+
+def extraction_stage(pages):
+    """
+    Pipeline stage: extract relations from annotated pages with SpanBERT or Gemini.
+    All terminal output about a page is printed here, so pages are reported one at a time.
+    With SpanBERT, the candidate pairs of every waiting page are predicted in one batched pass.
+
+    Input: list of page dictionaries with their spaCy docs
+    Output: the pages with their extracted relations
+    """
+    global pages_reported
+
+    # Start SpanBERT on all pages that need it; each page's results (and log) come out when requested below
+    to_extract = [page for page in pages if "skip" not in page]
+    spanbert_results = None
+    if extraction_method == "spanbert" and to_extract:
+        spanbert_results = spanbert_relation_extraction_batch([page["doc"] for page in to_extract],
+                                                              extraction_type, confidence_threshold)
+
+    for page in pages:
+        # print current url to user
+        pages_reported += 1
+        print(f"URL ( {pages_reported} / {page['total']}): ", page["url"])
+
+        page["relations"] = {} if extraction_method == "spanbert" else []
+        if page.get("text") is not None:
+            if page["trimmed"]:
+                print(f"        Trimming webpage content to {max_text_chars} characters")
+            print(f"        Webpage length (num characters): {len(page['text'])}")
+        if "skip" in page:
+            print(f"        {page['skip']}")
+            continue
+
+        # perform Annotation and Information Extraction using spaCy(relation_extraction.py)
+        print(f"        Annotating the webpage using spacy...")
+
+        # extract relations extractions by using gemini or spanbert(relation_extraction.py)
+        # A failing page is reported and kept with no relations; it must not take the rest of the batch with it
+        try:
+            if extraction_method == "spanbert":
+                if spanbert_results is not None:
+                    try:
+                        page["relations"] = next(spanbert_results)
+                    except Exception:
+                        # The batched pass is over once it raises; run this page and the rest one at a time
+                        print(f"        Batched SpanBERT extraction failed, continuing page by page:\n{traceback.format_exc()}")
+                        spanbert_results = None
+                if spanbert_results is None:
+                    page["relations"] = spanbert_relation_extraction(page["text"], extraction_type,
+                                                                     confidence_threshold, doc=page["doc"])
+            elif extraction_method == "gemini":
+                page["relations"] = gemini_relation_extraction(page["text"], gemini_api_key, extraction_type, doc=page["doc"])
+        except Exception:
+            print(f"        Relation extraction failed for this webpage:\n{traceback.format_exc()}")
+            page["relations"] = {} if extraction_method == "spanbert" else []
+            # Let a mirror of this page be extracted instead of being skipped as its duplicate
+            duplicate_index.remove(page["url"])
+
+    return pages
+
+
+def build_pipeline():
+    """
+    Build the page pipeline: fetched pages -> text extraction -> spaCy annotation -> relation extraction.
+    Fetching itself is done by AsyncFetcher, which feeds the first stage.
+
+    Input: N/A
+    Output: Pipeline (not started)
+    """
+    return Pipeline([
+        Stage("text", text_stage, workers=text_workers),
+        Stage("nlp", nlp_stage, workers=nlp_workers, batch_size=nlp_batch_pages),
+        Stage("extract", extraction_stage, workers=extract_workers, batch_size=extract_batch_pages),
+    ], queue_size=pipeline_queue_size)
+
+
 def run_ise_algorithm():
     """
     Main loop of program. This will run until a desired number of tuples is reached, or (if there is no new query to be generated from the results) the programed is halted.
@@ -179,11 +348,15 @@ def run_ise_algorithm():
     Input: N/A
     Output: Initates URL scraping for results generated by user query. From there text is processed for relationship tuples. 
     """
-    global seed_query, seen_urls
+    global seed_query, seen_urls, pages_reported
 
     X = set()
     iteration = 0
 
+    # start the text extraction / annotation / relation extraction stages, reused by every iteration
+    pipeline = build_pipeline()
+    pipeline.start()
+
     # Display search parameters lines to user
     query_print_cmd(iteration,extraction_method)
 
@@ -191,10 +364,16 @@ def run_ise_algorithm():
     while len(X) < num_tuples:
         # print current iteration and query to user
         print(f"=========== Iteration: {iteration} - Query: {seed_query} ===========\n")
+        pages_reported = 0
 
         # perform google api search for 10 urls based on seed query
         url_results = search()
 
+        # report how often the search cache saved an API call
+        if search_cache is not None:
+            stats = search_cache.stats()
+            print(f"Search cache: {stats['hits']} hits / {stats['misses']} misses\n")
+
         # remove urls that have already been seen
         url_results = [url for url in url_results if url not in seen_urls]
 
@@ -202,48 +381,50 @@ def run_ise_algorithm():
             print("All the urls have already been seen.. Stopping Program.")
             sys.exit(0)
 
-        # loop through the results and perform 
-        for i, url in enumerate(url_results):
-            # add url to seen_urls
-            seen_urls.add(url)
-            
-            # print current url to user
-            print(f"URL ( {i + 1} / {len(url_results)}): ", url)
-
-            # fetch the website from the url
-            html = fetch_website(url)
-
-            #check if html is None (website not found i.e timeout)
-            if html is None:
-                continue
+        # fetch all urls of this iteration concurrently; pages are handed over as soon as they arrive
+        # the scheduler rate limits each host and stops fetching at this iteration's deadline
+        fetch_scheduler.start_iteration()
+        fetcher = AsyncFetcher(max_concurrency=fetch_concurrency, per_host_limit=fetch_per_host, fetch=fetch_scheduler.fetch)
 
-            # extract plain text from html
-            plain_text = extract_plain_text(html)
+        # add urls to seen_urls
+        seen_urls.update(url_results)
 
-            print(f"        Webpage length (num characters): {len(plain_text)}")
+        # run the pages through text extraction, spaCy and relation extraction while the rest keep downloading
+        pages = ({"url": url, "html": html, "total": len(url_results)} for _, url, html in fetcher.iter_fetch(url_results))
+        annotated_texts = []
+        for page in pipeline.run(pages):
+            if "skip" not in page:
+                annotated_texts.append(page["text"])
 
-            # perform Annotation and Information Extraction using spaCy(relation_extraction.py)
-            print(f"        Annotating the webpage using spacy...")
-        
-            # extract relations extractions by using gemini or spanbert(relation_extraction.py)
-            if extraction_method == "spanbert" :
-                relations = spanbert_relation_extraction(plain_text,extraction_type,confidence_threshold)
-
-                # add individual tuples to the set X
-                for key, value in relations.items():
+            # add individual tuples to the set X
+            if extraction_method == "spanbert":
+                for key, value in page["relations"].items():
                     subject, obj = key
                     confidence = value
                     X.add((subject, obj, confidence))
-            
-            elif extraction_method == "gemini":
-                relations = gemini_relation_extraction(plain_text, gemini_api_key, extraction_type)
 
-                # add individual tuples to the set X
-                for relation in relations:
+            elif extraction_method == "gemini":
+                for relation in page["relations"]:
                     subject = relation["subj"]
                     obj = relation["obj"]
                     X.add((subject, obj))
 
+        # report annotation work saved by near-duplicate detection, how fetching went and how busy each stage was
+        print(f"\n{duplicate_index.report()}")
+        print(f"{fetch_scheduler.report()}")
+        early_exit = spanbert_report()
+        if early_exit is not None:
+            print(early_exit)
+        print(f"{pipeline.report()}\n")
+
+        # models are loaded on first use, so after the first iteration we know what this run loaded
+        if iteration == 0:
+            print(f"{startup_report()}\n")
+            # time each spaCy component on this iteration's pages, to compare profiles (--spacy-profile)
+            if spacy_timings and annotated_texts:
+                report_spacy_timings(annotated_texts)
+                print()
+
         # remove duplicates from X (get both the list and set of X , easy to print final result)
         X_list, X = remove_tuple_duplicates(X)
 
@@ -293,10 +474,12 @@ def cmd_line():
 
     # Declare global variables to be used across program
     global google_api_key, gemini_api_key, cx, seed_query, num_tuples, confidence_threshold, extraction_method, extraction_type
+    global spacy_timings
 
-    # If too few or too many args passed, exit and explain
-    if len(sys.argv) != 9:
-        print("Usage: python project2.py [-spanbert|-gemini] <google api key> <google engine id> <google gemini api key> <r> <t> <q> <k>")
+    # If too few args passed, exit and explain
+    if len(sys.argv) < 9:
+        print("Usage: python project2.py [-spanbert|-gemini] <google api key> <google engine id> <google gemini api key> <r> <t> <q> <k> "
+              "[--spacy-profile <profile>] [--spacy-timings]")
         exit(1)
 
     # Extract command line arguments: google api key, google engine key, gemini api key, extraction type, confidence threshold, seed query, number of tuples
@@ -341,6 +524,17 @@ def cmd_line():
         if num_tuples <= 0:
             raise ValueError("Number of Tuples must be greater than 0.")
 
+        # Optional settings after the required arguments
+        options = sys.argv[9:]
+        while options:
+            option = options.pop(0)
+            if option == "--spacy-profile" and options:
+                set_spacy_profile(options.pop(0))
+            elif option == "--spacy-timings":
+                spacy_timings = True
+            else:
+                raise ValueError(f"Unknown option '{option}'.")
+
     except ValueError as e:
         print(f"Error: {e}")
         sys.exit(1)
@@ -364,13 +558,22 @@ def query_print_cmd(iteration, extraction_method):
     print(f"Threshold  = {confidence_threshold}")
     print(f"Query      = {seed_query}")
     print(f"# of Tuples  = {num_tuples}")
+    print(f"spaCy      = {nlp_model.name}{', timing components' if spacy_timings else ''}")
     print("Loading necessary libraries; This should take a minute or so ...")
 
 # Main function - start of the information extraction process
 def main():
+    global search_cache
+
     # Read in the required keys, seed query, relation method and type, number of tuples from command-line
     cmd_line()
 
+    # Reuse pages downloaded by earlier runs
+    enable_response_cache(os.path.join(cache_dir, "pages"), max_bytes=page_cache_bytes, ttl=page_cache_ttl)
+
+    # Reuse search results of earlier runs
+    search_cache = SearchCache(os.path.join(cache_dir, "search.json"), max_entries=search_cache_entries, ttl=search_cache_ttl)
+
     # Initiate information extraction with user input
     run_ise_algorithm()
 
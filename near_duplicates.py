@@ -0,0 +1,135 @@
+"""
+This file contains near-duplicate page detection. Search results often return syndicated copies or mirrors
+of the same article under different URLs; fingerprinting the extracted plain text lets us skip annotating
+the same text twice.
+"""
+
+# Environment Set Up
+import hashlib
+import re
+import threading
+
+WORDS = re.compile(r'\w+')
+
+
+def simhash(text, shingle_size=3, bits=64):
+    """
+    Compute the SimHash fingerprint of a text over word shingles.
+
+    Similar texts get fingerprints that differ in only a few bits, so the Hamming distance between
+    two fingerprints approximates how different the texts are.
+
+    Input: plain text, number of words per shingle, fingerprint size in bits
+    Output: fingerprint as an int, or None if the text is too short to fingerprint
+    """
+    words = WORDS.findall(text.lower())
+    if len(words) < shingle_size:
+        return None
+
+    weights = [0] * bits
+    for i in range(len(words) - shingle_size + 1):
+        shingle = " ".join(words[i:i + shingle_size])
+        h = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=bits // 8).digest(), "big")
+        for bit in range(bits):
+            if h >> bit & 1:
+                weights[bit] += 1
+            else:
+                weights[bit] -= 1
+
+    fingerprint = 0
+    for bit in range(bits):
+        if weights[bit] > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+class SimHashIndex:
+    """
+    Index of page fingerprints seen so far in a run.
+
+    Fingerprints are split into max_distance + 1 bands; by the pigeonhole principle two fingerprints within
+    max_distance bits share at least one identical band, so only pages in matching band buckets are compared.
+    """
+
+    def __init__(self, max_distance=3, bits=64, min_words=50):
+        self.max_distance = max_distance
+        self.bits = bits
+        self.min_words = min_words
+        self.num_bands = max_distance + 1
+        self.band_width = bits // self.num_bands
+        self.buckets = [{} for _ in range(self.num_bands)]
+        self.fingerprints = {}
+        self._lock = threading.Lock()
+
+        # Work saved by skipping duplicates
+        self.pages_checked = 0
+        self.pages_skipped = 0
+        self.chars_skipped = 0
+
+    def _bands(self, fingerprint):
+        mask = (1 << self.band_width) - 1
+        return [(fingerprint >> (band * self.band_width)) & mask for band in range(self.num_bands)]
+
+    def find(self, fingerprint):
+        """
+        Find an indexed page whose fingerprint is within max_distance bits.
+
+        Input: fingerprint
+        Output: URL of the matching page, or None
+        """
+        for band, value in enumerate(self._bands(fingerprint)):
+            for url in self.buckets[band].get(value, ()):
+                if bin(fingerprint ^ self.fingerprints[url]).count("1") <= self.max_distance:
+                    return url
+        return None
+
+    def check_and_add(self, url, text):
+        """
+        Check a page against every page seen so far; new pages are added to the index.
+
+        Input: URL and extracted plain text of the page
+        Output: URL of the page this one duplicates, or None if it is new (or too short to judge)
+        """
+        # Very short pages (error pages, paywalls) would all look alike, so they are never matched
+        if len(WORDS.findall(text)) < self.min_words:
+            return None
+
+        fingerprint = simhash(text, bits=self.bits)
+
+        # Pages can be checked from several threads; look up and insert in one step
+        with self._lock:
+            self.pages_checked += 1
+            duplicate_of = self.find(fingerprint)
+            if duplicate_of is not None:
+                self.pages_skipped += 1
+                self.chars_skipped += len(text)
+                return duplicate_of
+
+            self.fingerprints[url] = fingerprint
+            for band, value in enumerate(self._bands(fingerprint)):
+                self.buckets[band].setdefault(value, []).append(url)
+            return None
+
+    def remove(self, url):
+        """
+        Drop a page from the index, so later copies of it are no longer treated as duplicates.
+
+        Input: URL of an indexed page
+        Output: N/A
+        """
+        with self._lock:
+            fingerprint = self.fingerprints.pop(url, None)
+            if fingerprint is None:
+                return
+            for band, value in enumerate(self._bands(fingerprint)):
+                self.buckets[band][value].remove(url)
+
+    def report(self):
+        """
+        Summary of annotation work skipped because of near-duplicate pages.
+
+        Input: N/A
+        Output: string for the terminal
+        """
+        return (f"Near-duplicate pages skipped: {self.pages_skipped} / {self.pages_checked} "
+                f"({self.chars_skipped} characters not annotated)")
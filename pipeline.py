@@ -0,0 +1,213 @@
+"""
+This file contains the staged pipeline used by ise_main.py to overlap network I/O with model inference.
+Pages flow fetch -> text extraction -> spaCy annotation -> relation extraction through bounded queues, and
+each stage has its own worker threads, so one page can be annotated while the next is parsed and others download.
+"""
+
+# Environment Set Up
+import queue
+import threading
+import traceback
+
+# Marker passed to the output queue when a stage drops an item (e.g. a page that could not be fetched)
+DROPPED = object()
+
+# Marker that tells a worker thread to exit
+_STOP = object()
+
+
+class _EndOfSource:
+    """
+    Marker put on the output queue once the feeder has handed over every item of a run (or the source
+    failed), carrying the number of items that actually entered the pipeline.
+    """
+
+    def __init__(self, count):
+        self.count = count
+
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    handler takes an item and returns the item for the next stage, or None to drop it. With batch_size > 1
+    the handler takes a list of up to batch_size items (whatever is waiting in the queue) and returns a list
+    of results in the same order, None entries being dropped.
+    """
+
+    def __init__(self, name, handler, workers=1, batch_size=1):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.batch_size = batch_size
+
+
+class Pipeline:
+    """
+    Runs items through a list of stages connected by bounded queues.
+
+    The pipeline is started once and reused across ISE iterations; run() feeds one iteration's items and
+    yields the final results as they come out of the last stage.
+    """
+
+    def __init__(self, stages, queue_size=8):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.output = queue.Queue()
+        self.max_depths = [0] * len(stages)
+        self.threads = [[] for _ in stages]
+        self._depth_lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the worker threads of every stage.
+
+        Input: N/A
+        Output: N/A
+        """
+        for index, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(index,), name=f"{stage.name}-{n}", daemon=True)
+                thread.start()
+                self.threads[index].append(thread)
+
+    def _put(self, index, item):
+        """
+        Hand an item to stage index (or to the output queue past the last stage), tracking queue depths.
+
+        Input: stage index, item
+        Output: N/A
+        """
+        if index == len(self.stages):
+            self.output.put(item)
+            return
+
+        self.queues[index].put(item)
+        with self._depth_lock:
+            self.max_depths[index] = max(self.max_depths[index], self.queues[index].qsize())
+
+    def _take(self, index):
+        """
+        Take the next batch of items for stage index: block for the first item, then take whatever else is
+        already waiting, up to the stage's batch size.
+
+        Input: stage index
+        Output: list of items (may end with _STOP)
+        """
+        items = [self.queues[index].get()]
+        while len(items) < self.stages[index].batch_size and items[-1] is not _STOP:
+            try:
+                items.append(self.queues[index].get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _work(self, index):
+        """
+        Worker loop of one stage thread.
+
+        Input: stage index
+        Output: N/A
+        """
+        stage = self.stages[index]
+        while True:
+            items = self._take(index)
+            stop = items[-1] is _STOP
+            if stop:
+                items.pop()
+
+            if items:
+                try:
+                    if stage.batch_size > 1:
+                        results = stage.handler(items)
+                    else:
+                        results = [stage.handler(items[0])]
+                except Exception:
+                    # A failing item must not stall the iteration; report it and drop it
+                    print(f"        Pipeline stage '{stage.name}' failed:\n{traceback.format_exc()}")
+                    results = [None] * len(items)
+
+                # run() counts one output per item, so a batch handler returning too few results drops the rest
+                results = list(results)[:len(items)]
+                results += [None] * (len(items) - len(results))
+
+                for result in results:
+                    if result is None:
+                        self.output.put(DROPPED)
+                    else:
+                        self._put(index + 1, result)
+
+            if stop:
+                return
+
+    def run(self, source):
+        """
+        Feed one iteration's items into the first stage and yield the final results as they finish.
+
+        Input: iterable of items for the first stage (consumed in a background thread)
+        Output: generator of results from the last stage, in completion order
+        """
+        def feed():
+            fed = 0
+            try:
+                for item in source:
+                    self._put(0, item)
+                    fed += 1
+            except Exception:
+                # A failing source ends the run early; the items already fed still come out
+                print(f"        Pipeline source failed:\n{traceback.format_exc()}")
+            finally:
+                self.output.put(_EndOfSource(fed))
+
+        feeder = threading.Thread(target=feed, name="feeder", daemon=True)
+        feeder.start()
+
+        # Every fed item ends either as a result or as a DROPPED marker; how many were fed is only known
+        # once the feeder is done
+        finished = 0
+        fed = None
+        while fed is None or finished < fed:
+            result = self.output.get()
+            if isinstance(result, _EndOfSource):
+                fed = result.count
+                continue
+            finished += 1
+            if result is not DROPPED:
+                yield result
+
+        feeder.join()
+
+    def queue_depths(self):
+        """
+        Number of items waiting in front of each stage right now, and the most seen so far.
+
+        Input: N/A
+        Output: dictionary of stage name -> (current depth, max depth)
+        """
+        with self._depth_lock:
+            return {stage.name: (q.qsize(), max_depth)
+                    for stage, q, max_depth in zip(self.stages, self.queues, self.max_depths)}
+
+    def report(self):
+        """
+        Queue depths formatted for the terminal.
+
+        Input: N/A
+        Output: string
+        """
+        depths = ", ".join(f"{name} {current}/{max_depth}" for name, (current, max_depth) in self.queue_depths().items())
+        return f"Pipeline queue depths (now/max): {depths}"
+
+    def close(self):
+        """
+        Stop all worker threads once their queues are drained. Stages are stopped front to back so no stage
+        stops while an earlier one may still hand it items.
+
+        Input: N/A
+        Output: N/A
+        """
+        for index, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                self.queues[index].put(_STOP)
+            for thread in self.threads[index]:
+                thread.join()
@@ -37,6 +37,9 @@ from .file_utils import cached_path, WEIGHTS_NAME, CONFIG_NAME
 
 logger = logging.getLogger(__name__)
 
+# Fused attention kernel (PyTorch >= 2.0); older versions use the explicit matmul/softmax path
+_sdpa = getattr(torch.nn.functional, "scaled_dot_product_attention", None)
+
 PRETRAINED_MODEL_ARCHIVE_MAP = {
     'bert-base-uncased': "https://s3.amazonaws.com/models.huggingface.co/bert/bert-base-uncased.tar.gz",
     'bert-large-uncased': "https://s3.amazonaws.com/models.huggingface.co/bert/bert-large-uncased.tar.gz",
@@ -275,6 +278,25 @@ class BertEmbeddings(nn.Module):
         return embeddings
 
 
+class PackedSequences(object):
+    """Positions of the real (unmasked) tokens of a padded batch. Packed hidden states hold only those
+    tokens, [total_tokens, hidden], so position-wise layers (projections, FFN, LayerNorm) skip the padding."""
+
+    def __init__(self, attention_mask):
+        self.batch_size, self.seq_length = attention_mask.size()
+        self.indices = attention_mask.reshape(-1).nonzero().squeeze(1)
+
+    def pack(self, x):
+        """[batch, seq, ...] -> [total_tokens, ...]"""
+        return x.reshape((self.batch_size * self.seq_length,) + x.size()[2:]).index_select(0, self.indices)
+
+    def unpack(self, x):
+        """[total_tokens, ...] -> [batch, seq, ...], zeros at padded positions"""
+        padded = x.new_zeros((self.batch_size * self.seq_length,) + x.size()[1:])
+        padded = padded.index_copy(0, self.indices, x)
+        return padded.view((self.batch_size, self.seq_length) + x.size()[1:])
+
+
 class BertSelfAttention(nn.Module):
     def __init__(self, config):
         super(BertSelfAttention, self).__init__()
@@ -289,43 +311,78 @@ class BertSelfAttention(nn.Module):
         self.query = nn.Linear(config.hidden_size, self.all_head_size)
         self.key = nn.Linear(config.hidden_size, self.all_head_size)
         self.value = nn.Linear(config.hidden_size, self.all_head_size)
+        # query, key and value packed into one projection by fuse_qkv()
+        self.qkv = None
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
 
+    def fuse_qkv(self):
+        """Replaces the query, key and value projections by a single nn.Linear computing all three in one
+        GEMM. The fused weights are built from the loaded ones, so checkpoints load unchanged."""
+        if self.qkv is not None:
+            return
+        qkv = nn.Linear(self.query.in_features, 3 * self.all_head_size)
+        qkv.to(device=self.query.weight.device, dtype=self.query.weight.dtype)
+        with torch.no_grad():
+            qkv.weight.copy_(torch.cat([self.query.weight, self.key.weight, self.value.weight], dim=0))
+            qkv.bias.copy_(torch.cat([self.query.bias, self.key.bias, self.value.bias], dim=0))
+        self.qkv = qkv
+        del self.query, self.key, self.value
+
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
-    def forward(self, hidden_states, attention_mask):
-        mixed_query_layer = self.query(hidden_states)
-        mixed_key_layer = self.key(hidden_states)
-        mixed_value_layer = self.value(hidden_states)
+    def forward(self, hidden_states, attention_mask, packing=None):
+        if packing is not None:
+            # projections run on the real tokens only; attention itself needs the padded per-sequence layout
+            if self.qkv is not None:
+                mixed_layer = packing.unpack(self.qkv(hidden_states))
+                new_shape = mixed_layer.size()[:-1] + (3, self.num_attention_heads, self.attention_head_size)
+                query_layer, key_layer, value_layer = mixed_layer.view(*new_shape).permute(2, 0, 3, 1, 4).unbind(0)
+            else:
+                query_layer = self.transpose_for_scores(packing.unpack(self.query(hidden_states)))
+                key_layer = self.transpose_for_scores(packing.unpack(self.key(hidden_states)))
+                value_layer = self.transpose_for_scores(packing.unpack(self.value(hidden_states)))
+        elif self.qkv is not None:
+            # [batch, seq, 3 * all_head_size] -> 3 x [batch, heads, seq, head_size]
+            mixed_layer = self.qkv(hidden_states)
+            new_shape = mixed_layer.size()[:-1] + (3, self.num_attention_heads, self.attention_head_size)
+            query_layer, key_layer, value_layer = mixed_layer.view(*new_shape).permute(2, 0, 3, 1, 4).unbind(0)
+        else:
+            query_layer = self.transpose_for_scores(self.query(hidden_states))
+            key_layer = self.transpose_for_scores(self.key(hidden_states))
+            value_layer = self.transpose_for_scores(self.value(hidden_states))
 
-        query_layer = self.transpose_for_scores(mixed_query_layer)
-        key_layer = self.transpose_for_scores(mixed_key_layer)
-        value_layer = self.transpose_for_scores(mixed_value_layer)
+        if not self.training and _sdpa is not None:
+            # Fused kernel for the scaling, mask, softmax and weighted sum; no dropout at inference
+            context_layer = _sdpa(query_layer, key_layer, value_layer, attn_mask=attention_mask)
+        else:
+            # Take the dot product between "query" and "key" to get the raw attention scores.
+            attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+            # assert not torch.isnan(attention_scores).any()
+            attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+            # assert not torch.isnan(attention_scores).any()
+            attention_scores = torch.clamp(attention_scores, -10000., 10000.)
+            # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
+            attention_scores = attention_scores + attention_mask
 
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-        # assert not torch.isnan(attention_scores).any()
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        # assert not torch.isnan(attention_scores).any()
-        attention_scores = torch.clamp(attention_scores, -10000., 10000.)
-        # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-        attention_scores = attention_scores + attention_mask
+            # Normalize the attention scores to probabilities.
+            attention_probs = torch.softmax(attention_scores, dim=-1)
 
-        # Normalize the attention scores to probabilities.
-        attention_probs = nn.Softmax(dim=-1)(attention_scores)
+            # This is actually dropping out entire tokens to attend to, which might
+            # seem a bit unusual, but is taken from the original Transformer paper.
+            if self.training:
+                attention_probs = self.dropout(attention_probs)
 
-        # This is actually dropping out entire tokens to attend to, which might
-        # seem a bit unusual, but is taken from the original Transformer paper.
-        attention_probs = self.dropout(attention_probs)
+            context_layer = torch.matmul(attention_probs, value_layer)
 
-        context_layer = torch.matmul(attention_probs, value_layer)
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
+        if packing is not None:
+            context_layer = packing.pack(context_layer)
         return context_layer
 
 
@@ -349,8 +406,8 @@ class BertAttention(nn.Module):
         self.self = BertSelfAttention(config)
         self.output = BertSelfOutput(config)
 
-    def forward(self, input_tensor, attention_mask):
-        self_output = self.self(input_tensor, attention_mask)
+    def forward(self, input_tensor, attention_mask, packing=None):
+        self_output = self.self(input_tensor, attention_mask, packing)
         attention_output = self.output(self_output, input_tensor)
         return attention_output
 
@@ -391,8 +448,8 @@ class BertLayer(nn.Module):
         self.intermediate = BertIntermediate(config)
         self.output = BertOutput(config)
 
-    def forward(self, hidden_states, attention_mask):
-        attention_output = self.attention(hidden_states, attention_mask)
+    def forward(self, hidden_states, attention_mask, packing=None):
+        attention_output = self.attention(hidden_states, attention_mask, packing)
         intermediate_output = self.intermediate(attention_output)
         layer_output = self.output(intermediate_output, attention_output)
         return layer_output
@@ -404,10 +461,10 @@ class BertEncoder(nn.Module):
         layer = BertLayer(config)
         self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])
 
-    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True):
+    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True, packing=None):
         all_encoder_layers = []
         for layer_module in self.layer:
-            hidden_states = layer_module(hidden_states, attention_mask)
+            hidden_states = layer_module(hidden_states, attention_mask, packing)
             if output_all_encoded_layers:
                 all_encoder_layers.append(hidden_states)
         if not output_all_encoded_layers:
@@ -513,6 +570,45 @@ class BertPreTrainedModel(nn.Module):
                 ))
         self.config = config
 
+    def fuse_qkv(self):
+        """ Packs the query/key/value projections of every attention layer into one projection
+            (see BertSelfAttention.fuse_qkv). Call after loading the weights.
+        """
+        for module in self.modules():
+            if isinstance(module, BertSelfAttention):
+                module.fuse_qkv()
+        return self
+
+    def checkpoint_state_dict(self):
+        """ State dict in the layout of the original checkpoints (fused qkv projections split back into
+            query/key/value), so a modified model can be saved and loaded with from_pretrained.
+        """
+        state_dict = self.state_dict()
+        for name in [name for name in state_dict if ".qkv." in name]:
+            prefix, param = name.split(".qkv.")
+            for part, tensor in zip(("query", "key", "value"), state_dict.pop(name).chunk(3, dim=0)):
+                state_dict["{}.{}.{}".format(prefix, part, param)] = tensor.clone()
+        return state_dict
+
+    def drop_layers(self, keep):
+        """ Layer dropping: keeps only the encoder layers whose indices are in `keep` (in that order) and
+            updates config.num_hidden_layers. Used to build smaller student models from a trained model.
+        """
+        for module in [module for module in self.modules() if isinstance(module, BertEncoder)]:
+            module.layer = nn.ModuleList([module.layer[i] for i in keep])
+        self.config.num_hidden_layers = len(keep)
+        return self
+
+    def enable_packed_inference(self, enabled=True):
+        """ In eval mode, run the encoder only on real tokens: padding is removed after the embeddings and
+            only re-added around the attention softmax, so the projections, FFN and LayerNorm of every layer
+            skip padded positions. Outputs for real tokens are unchanged.
+        """
+        for module in self.modules():
+            if isinstance(module, BertModel):
+                module.packed_inference = enabled
+        return self
+
     def init_bert_weights(self, module):
         """ Initialize the weights.
         """
@@ -704,8 +800,22 @@ class BertModel(BertPreTrainedModel):
         self.embeddings = BertEmbeddings(config)
         self.encoder = BertEncoder(config)
         self.pooler = BertPooler(config)
+        # at inference, run the encoder on real tokens only (see enable_packed_inference)
+        self.packed_inference = False
         self.apply(self.init_bert_weights)
 
+    def get_extended_attention_mask(self, attention_mask):
+        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+
+        # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
+        # masked positions, this operation will create a tensor which is 0.0 for
+        # positions we want to attend and -10000.0 for masked positions.
+        # Since we are adding it to the raw scores before the softmax, this is
+        # effectively the same as removing these entirely.
+        extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype) # fp16 compatibility
+        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        return extended_attention_mask
+
     def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
@@ -717,20 +827,24 @@ class BertModel(BertPreTrainedModel):
         # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
         # this attention mask is more simple than the triangular masking of causal attention
         # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
-        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
-
-        # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
-        # masked positions, this operation will create a tensor which is 0.0 for
-        # positions we want to attend and -10000.0 for masked positions.
-        # Since we are adding it to the raw scores before the softmax, this is
-        # effectively the same as removing these entirely.
-        extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype) # fp16 compatibility
-        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        extended_attention_mask = self.get_extended_attention_mask(attention_mask)
 
         embedding_output = self.embeddings(input_ids, token_type_ids)
+
+        # Packed mode: strip the padding before the encoder stack
+        packing = None
+        if self.packed_inference and not self.training:
+            packing = PackedSequences(attention_mask)
+            embedding_output = packing.pack(embedding_output)
+
         encoded_layers = self.encoder(embedding_output,
                                       extended_attention_mask,
-                                      output_all_encoded_layers=output_all_encoded_layers)
+                                      output_all_encoded_layers=output_all_encoded_layers,
+                                      packing=packing)
+
+        # Back to [batch, seq, hidden] so [CLS] is at position 0 for the pooler (padded positions are zeros)
+        if packing is not None:
+            encoded_layers = [packing.unpack(layer) for layer in encoded_layers]
         sequence_output = encoded_layers[-1]
         pooled_output = self.pooler(sequence_output)
         if not output_all_encoded_layers:
@@ -932,6 +1046,132 @@ class BertForNextSentencePrediction(BertPreTrainedModel):
             return seq_relationship_score
 
 
+class BertLabelSubset(object):
+    """Labels of BertForSequenceClassification needed by the caller at inference, e.g. the relations of
+    interest plus the "no relation" label. Only the `keep` logits are returned, so the label and softmax
+    confidence of an example are read off a handful of columns.
+
+    With `exact`, two columns are appended: the largest logit and the logsumexp of the other labels. They
+    make the softmax over the kept columns exactly the full softmax, and tell whether another label would
+    have won the argmax. Without it, the other classifier rows are never computed and the softmax is
+    renormalised over the kept labels only (cheaper, but confidences are no longer the full model's).
+
+    Params:
+        `keep`: label indices whose logits are returned, in output order
+        `screen`: label indices that must stay reachable for an example to run deeper (see early exit)
+        `exact`: keep the full-softmax normalisation
+    """
+    def __init__(self, keep, screen=None, exact=True):
+        self.keep = list(keep)
+        self.screen = list(screen or [])
+        self.exact = exact
+        self._indices = {}
+
+    def width(self):
+        return len(self.keep) + (2 if self.exact else 0)
+
+    def indices(self, device):
+        """Kept label indices, screened label indices and the output columns of the screened labels, as
+        tensors on a device (cached)."""
+        if device not in self._indices:
+            self._indices[device] = tuple(torch.tensor(values, dtype=torch.long, device=device) for values in
+                                          (self.keep, self.screen, [self.keep.index(i) for i in self.screen]))
+        return self._indices[device]
+
+    def restrict(self, logits):
+        """Output columns of the subset, from the logits of every label."""
+        keep = self.indices(logits.device)[0]
+        kept = logits.index_select(1, keep)
+        if not self.exact:
+            return kept
+        other = logits.clone()
+        other[:, keep] = float("-inf")
+        return torch.cat([kept, other.max(dim=1, keepdim=True)[0], other.logsumexp(dim=1, keepdim=True)], dim=1)
+
+    def classify(self, classifier, pooled_output):
+        """Output columns of the subset, from the pooled output and the classifier layer."""
+        if self.exact:
+            # normalisation needs the logit of every label
+            return self.restrict(classifier(pooled_output))
+        weight = classifier.weight() if callable(classifier.weight) else classifier.weight
+        bias = classifier.bias() if callable(classifier.bias) else classifier.bias
+        if weight.is_quantized:
+            weight = weight.dequantize()
+        keep = self.indices(weight.device)[0]
+        return nn.functional.linear(pooled_output, weight.index_select(0, keep).to(pooled_output.dtype),
+                                    bias.index_select(0, keep).to(pooled_output.dtype))
+
+    def screen_out(self, columns):
+        """Make the screened labels unreachable in subset output columns."""
+        columns = columns.clone()
+        columns[:, self.indices(columns.device)[2]] = float("-inf")
+        return columns
+
+
+class BertEarlyExitHeads(nn.Module):
+    """Lightweight classifiers on the [CLS] state of intermediate encoder layers, for early exit in
+    BertForSequenceClassification. Each head has the shape of the model's own pooler + classifier and is
+    initialised from them; they are then trained to match the final logits (see spanbert_distill.py).
+
+    Params:
+        `config`: BertConfig of the model
+        `num_labels`: number of classes
+        `exit_layers`: 0-based indices of the encoder layers followed by a head
+        `threshold`: softmax confidence at which an example exits
+        `screen_threshold`: with a BertLabelSubset screening `screen_labels`, an example also exits once an
+            exit head gives those labels less probability than this in total (0 disables the screen)
+        `screen_labels`: label indices the screen threshold was calibrated for
+    """
+    def __init__(self, config, num_labels, exit_layers, threshold=1.0, screen_threshold=0.0, screen_labels=None):
+        super(BertEarlyExitHeads, self).__init__()
+        self.exit_layers = list(exit_layers)
+        self.num_hidden_layers = config.num_hidden_layers
+        self.threshold = threshold
+        self.screen_threshold = screen_threshold
+        self.screen_labels = list(screen_labels or [])
+        self.heads = nn.ModuleList([nn.Sequential(nn.Linear(config.hidden_size, config.hidden_size), nn.Tanh(),
+                                                  nn.Linear(config.hidden_size, num_labels))
+                                    for _ in self.exit_layers])
+        # examples that left at each layer since reset_exit_counts() (the last layer counts full-depth examples)
+        self.exit_counts = [0] * config.num_hidden_layers
+
+    def init_from(self, model):
+        """Copies the pooler and classifier weights of a BertForSequenceClassification into every head."""
+        with torch.no_grad():
+            for head in self.heads:
+                head[0].weight.copy_(model.bert.pooler.dense.weight)
+                head[0].bias.copy_(model.bert.pooler.dense.bias)
+                head[2].weight.copy_(model.classifier.weight)
+                head[2].bias.copy_(model.classifier.bias)
+        return self
+
+    def forward_all(self, encoded_layers):
+        """Logits of every head, given the output of every encoder layer (output_all_encoded_layers=True)."""
+        return [head(encoded_layers[index][:, 0]) for index, head in zip(self.exit_layers, self.heads)]
+
+    def reset_exit_counts(self):
+        self.exit_counts = [0] * self.num_hidden_layers
+
+    def average_layers(self):
+        """Average number of encoder layers run per example since reset_exit_counts()."""
+        total = sum(self.exit_counts)
+        return sum((index + 1) * count for index, count in enumerate(self.exit_counts)) / total if total else 0.0
+
+    def save(self, path):
+        torch.save({"exit_layers": self.exit_layers, "num_hidden_layers": self.num_hidden_layers,
+                    "threshold": self.threshold, "screen_threshold": self.screen_threshold,
+                    "screen_labels": self.screen_labels, "state_dict": self.state_dict()}, path)
+
+    @classmethod
+    def load(cls, path, config, num_labels):
+        saved = torch.load(path, map_location='cpu')
+        heads = cls(config, num_labels, saved["exit_layers"], saved["threshold"], saved.get("screen_threshold", 0.0),
+                    saved.get("screen_labels"))
+        heads.num_hidden_layers = saved["num_hidden_layers"]
+        heads.load_state_dict(saved["state_dict"])
+        return heads
+
+
 class BertForSequenceClassification(BertPreTrainedModel):
     """BERT model for classification.
     This module is composed of the BERT model with a linear layer on top of
@@ -954,12 +1194,14 @@ class BertForSequenceClassification(BertPreTrainedModel):
             a batch has varying length sentences.
         `labels`: labels for the classification output: torch.LongTensor of shape [batch_size]
             with indices selected in [0, ..., num_labels].
+        `label_subset`: an optional BertLabelSubset (inference only) restricting the output to some labels.
 
     Outputs:
         if `labels` is not `None`:
             Outputs the CrossEntropy classification loss of the output with the labels.
         if `labels` is `None`:
-            Outputs the classification logits of shape [batch_size, num_labels].
+            Outputs the classification logits of shape [batch_size, num_labels]
+            ([batch_size, label_subset.width()] with a `label_subset`).
 
     Example usage:
     ```python
@@ -984,10 +1226,84 @@ class BertForSequenceClassification(BertPreTrainedModel):
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         self.classifier = nn.Linear(config.hidden_size, num_labels)
         self.apply(self.init_bert_weights)
+        # intermediate classifier heads used at inference (see enable_early_exit)
+        self.early_exit = None
+
+    def enable_early_exit(self, heads):
+        """ Attach trained BertEarlyExitHeads: at inference, examples whose prediction at an exit layer is
+            already confident enough stop there instead of running every encoder layer.
+        """
+        if heads is not None and heads.num_hidden_layers != self.config.num_hidden_layers:
+            raise ValueError("Early exit heads were built for {} layers, the model has {}".format(
+                heads.num_hidden_layers, self.config.num_hidden_layers))
+        self.early_exit = heads
+        return self
+
+    def early_exit_forward(self, input_ids, token_type_ids=None, attention_mask=None, label_subset=None):
+        """ Inference with early exit. After each exit layer, the examples whose exit head is at least
+            `threshold` confident take that head's logits and leave the batch, so later layers run on a
+            shrinking batch. Examples that never exit get the regular pooler/classifier logits.
+            With a `label_subset` screening the labels the heads' `screen_threshold` was calibrated for,
+            examples whose screened labels have become unlikely leave as well, with those labels ruled out.
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+
+        heads = self.early_exit
+        exits = dict(zip(heads.exit_layers, heads.heads))
+        screen = (label_subset is not None and heads.screen_threshold > 0 and label_subset.screen
+                  and sorted(label_subset.screen) == sorted(heads.screen_labels))
+        extended_attention_mask = self.bert.get_extended_attention_mask(attention_mask)
+        hidden_states = self.bert.embeddings(input_ids, token_type_ids)
+
+        width = self.num_labels if label_subset is None else label_subset.width()
+        logits = hidden_states.new_zeros(input_ids.size(0), width)
+        active = torch.arange(input_ids.size(0), device=input_ids.device)
+        for index, layer_module in enumerate(self.bert.encoder.layer):
+            hidden_states = layer_module(hidden_states, extended_attention_mask)
+            if index not in exits:
+                continue
+
+            exit_logits = exits[index](hidden_states[:, 0])
+            exit_proba = torch.softmax(exit_logits.float(), dim=-1)
+            leaving = exit_proba.max(dim=-1)[0] >= heads.threshold
+            if label_subset is not None:
+                exit_logits = label_subset.restrict(exit_logits)
+            if screen:
+                screened = exit_proba.index_select(1, label_subset.indices(exit_proba.device)[1])
+                unreachable = screened.sum(dim=-1) < heads.screen_threshold
+                exit_logits = torch.where(unreachable.unsqueeze(1), label_subset.screen_out(exit_logits), exit_logits)
+                leaving = leaving | unreachable
+            # one host sync per exit layer: shrinking the batch needs the count anyway
+            num_leaving = int(leaving.sum())
+            heads.exit_counts[index] += num_leaving
+            if num_leaving:
+                logits[active[leaving]] = exit_logits[leaving].to(logits.dtype)
+                remaining = ~leaving
+                active = active[remaining]
+                hidden_states = hidden_states[remaining]
+                extended_attention_mask = extended_attention_mask[remaining]
+                if active.numel() == 0:
+                    return logits
+
+        heads.exit_counts[len(self.bert.encoder.layer) - 1] += active.numel()
+        pooled_output = self.bert.pooler(hidden_states)
+        if label_subset is None:
+            logits[active] = self.classifier(pooled_output).to(logits.dtype)
+        else:
+            logits[active] = label_subset.classify(self.classifier, pooled_output).to(logits.dtype)
+        return logits
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None, label_subset=None):
+        if self.early_exit is not None and not self.training and labels is None:
+            return self.early_exit_forward(input_ids, token_type_ids, attention_mask, label_subset)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None):
         _, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
         pooled_output = self.dropout(pooled_output)
+        if label_subset is not None and labels is None:
+            return label_subset.classify(self.classifier, pooled_output)
         logits = self.classifier(pooled_output)
 
         if labels is not None:
@@ -4,46 +4,187 @@ This file initiates the entity extraction process and diverts scraped text to ei
 """
 
 import spacy
+import threading
+import time
 import google.generativeai as genai
 
 # Used to handle results returned by Gemini
 import ast
 
-# Load pre-trained SpanBERT model
-from spanbert import SpanBERT 
 from spacy_help_functions import *
-spanbert = SpanBERT("./pretrained_spanbert")  
 
 # Load helper functions for gemini extraction
 from gemini_help_functions import *
 
-# Load the spaCy English language model
-nlp = spacy.load("en_core_web_lg")
 
-def spanbert_relation_extraction(text, desired_type, conf):
+class LazyModel:
+    """
+    Handle to a model that is only built the first time it is used, so a run only pays for the models its
+    extraction method needs (a -gemini run never loads SpanBERT). Records how long loading took.
+    """
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self.model = None
+        self.load_seconds = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return the model, loading it on first use. Safe to call from several pipeline threads.
+
+        Input: N/A
+        Output: the loaded model
+        """
+        if self.model is None:
+            with self._lock:
+                if self.model is None:
+                    start = time.perf_counter()
+                    self.model = self.loader()
+                    self.load_seconds = time.perf_counter() - start
+                    print(f"        Loaded {self.name} in {self.load_seconds:.1f}s")
+        return self.model
+
+
+def load_spanbert():
+    """
+    Build the pre-trained SpanBERT model. torch and the model code are only imported here.
+
+    Input: N/A
+    Output: SpanBERT
+    """
+    from spanbert import SpanBERT
+    return SpanBERT(spanbert_dir, quantize=spanbert_quantize, backend=spanbert_backend, packed=spanbert_packed,
+                    num_layers=spanbert_num_layers, early_exit=spanbert_early_exit)
+
+
+# SpanBERT checkpoint folder: the full 24 layer model, or a faster distilled student built with
+# spanbert_distill.py (e.g. "./pretrained_spanbert_L12") for bulk crawling
+spanbert_dir = "./pretrained_spanbert"
+
+# Keep only this many evenly spaced encoder layers of the checkpoint (None keeps all; no distillation, so
+# check the accuracy with "python3 spanbert_distill.py tradeoff --layers N" first)
+spanbert_num_layers = None
+
+# JSON lines file collecting every candidate pair sent to SpanBERT (distillation data), or None
+spanbert_example_log = None
+
+# Let confident pairs leave SpanBERT at intermediate layers; needs heads trained and calibrated with
+# "python3 spanbert_distill.py early-exit" in spanbert_dir
+spanbert_early_exit = False
+
+# Score only no_relation and the relations of interest: "exact" (same extracted relations and confidences),
+# "subset" (softmax over those labels only, confidences change) or None (all 42 labels). With early exit,
+# pairs whose relations of interest become unlikely at an exit head also leave early
+spanbert_label_pruning = "exact"
+
+
+# Run SpanBERT with int8 weights on CPU (faster and ~4x smaller; check the accuracy delta with
+# "python3 spanbert.py --compare-quantized" before turning it on)
+spanbert_quantize = False
+
+# Strip padding before SpanBERT's encoder layers (same predictions, less compute on mixed-length batches)
+spanbert_packed = True
+
+# Runtime SpanBERT runs on: "torch" (eager PyTorch), "onnx" (ONNX Runtime) or "torchscript" (traced and
+# frozen module), see spanbert_runtime.py
+spanbert_backend = "torch"
+
+# spaCy pipeline profile: only the components extraction needs (see SPACY_PROFILES)
+spacy_profile = "ner_parser"
+
+# Pre-trained SpanBERT model and the spaCy English language model, loaded on first use
+spanbert_model = LazyModel("SpanBERT", load_spanbert)
+nlp_model = LazyModel(f"spaCy en_core_web_lg ({spacy_profile})", lambda: load_spacy_pipeline("en_core_web_lg", spacy_profile))
+
+
+def set_spacy_profile(profile):
+    """
+    Choose the spaCy pipeline profile before the spaCy model is first used (e.g. from a command line option).
+
+    Input: profile name from SPACY_PROFILES
+    Output: N/A (raises ValueError for an unknown profile)
+    """
+    global spacy_profile
+    if profile not in SPACY_PROFILES:
+        raise ValueError("Unknown spaCy profile '{}'. Choose one of: {}".format(profile, ", ".join(SPACY_PROFILES)))
+    spacy_profile = profile
+    nlp_model.name = f"spaCy en_core_web_lg ({spacy_profile})"
+
+
+def startup_report():
+    """
+    Summary of which models this run loaded and how long each took.
+
+    Input: N/A
+    Output: string for the terminal
+    """
+    lines = ["Model load times:"]
+    for handle in (nlp_model, spanbert_model):
+        if handle.load_seconds is None:
+            lines.append(f"    {handle.name}: not loaded")
+        else:
+            lines.append(f"    {handle.name}: {handle.load_seconds:.1f}s")
+    return "\n".join(lines)
+
+def spanbert_report():
+    """
+    Summary of SpanBERT's early exit since the last report, if SpanBERT is loaded and uses it.
+
+    Input: N/A
+    Output: string for the terminal, or None
+    """
+    if spanbert_model.model is None:
+        return None
+    return spanbert_model.model.early_exit_report()
+
+# Batch settings for annotate_pages() (docs per nlp.pipe batch, number of worker processes)
+spacy_batch_size = 16
+spacy_n_process = 1
+
+def spanbert_relation_extraction(text, desired_type, conf, doc=None):
     """
     Helper function to handle text when -spanbert is selected.
-    Input: Raw Text, a list of entities belonging to desired relation, confidence threshold.
+    Input: Raw Text, a list of entities belonging to desired relation, confidence threshold, spaCy doc of the text if already annotated.
     Output: Returns a dictionary of relations to be handled and printed out for the user.
     """
 
-    # Tag named entities of raw text using spaCy
-    doc = extract_entities(text)
+    # Tag named entities of raw text using spaCy (unless the pipeline already did)
+    if doc is None:
+        doc = extract_entities(text)
 
     # Get the desired entity types and entity relationship from user input
     entity_type, relation_type = get_entity_type(desired_type)
 
     # Use SpanBERT to return the relations between desired entity types and their confidence
-    relations = extract_relations(doc, spanbert, conf, entity_type, relation_type)
+    relations = extract_relations(doc, spanbert_model.get(), conf, entity_type, relation_type)
 
     return dict(relations)
 
+def spanbert_relation_extraction_batch(docs, desired_type, conf):
+    """
+    Helper function to handle several annotated pages at once when -spanbert is selected. Candidate pairs of all
+    pages are sent through SpanBERT together so its batches are full, instead of one small batch per sentence.
+    Input: list of spaCy docs, a list of entities belonging to desired relation, confidence threshold.
+    Output: generator of relation dictionaries, one per doc in order. SpanBERT runs when the first one is requested,
+            and each page's extraction log is printed as its dictionary is requested.
+    """
+
+    # Get the desired entity types and entity relationship from user input
+    entity_type, relation_type = get_entity_type(desired_type)
+
+    # Use SpanBERT to return the relations between desired entity types and their confidence
+    for relations in extract_relations_batch(docs, spanbert_model.get(), conf, entity_type, relation_type,
+                                             example_log=spanbert_example_log, label_pruning=spanbert_label_pruning):
+        yield dict(relations)
+
 def gemini_relation_extraction(text, gemini_api_key, desired_type, model_name='gemini-1.0-pro', max_tokens=2048,
-                               temperature=0.9, top_p=1, top_k=1):
+                               temperature=0.9, top_p=1, top_k=1, doc=None):
     """
     Method to handle text when Gemini is selected as the model.
 
-    Input: plain text, Gemini API key, desired relationship between entities, Gemini model parameters
+    Input: plain text, Gemini API key, desired relationship between entities, Gemini model parameters, spaCy doc of the text if already annotated
     Output: 
     """
 
@@ -93,8 +234,10 @@ def gemini_relation_extraction(text, gemini_api_key, desired_type, model_name='g
     # Initialize list to store extracted tuples
     extracted_tuples = []
 
-    # Parse the document into sentences
-    sentences = list(extract_entities(text).sents)
+    # Parse the document into sentences (reusing the spaCy doc if the pipeline already annotated the text)
+    if doc is None:
+        doc = extract_entities(text)
+    sentences = list(doc.sents)
 
     num_sentences = len(sentences)
 
@@ -183,11 +326,43 @@ def extract_entities(text):
     Output: text processed by the spaCy library for named entities
     """
     # Extract named entities using spaCy that meet the user selected extraction type
-    doc = nlp(text)
+    doc = nlp_model.get()(text)
     
     return doc
     
 
+def annotate_pages(texts, batch_size=None, n_process=None):
+    """
+    Tag named entities for many pages at once with spaCy's nlp.pipe, which is much faster than one nlp() call
+    per page on many small documents.
+
+    Input: iterable of plain texts, number of texts per batch (defaults to spacy_batch_size),
+           number of worker processes (defaults to spacy_n_process)
+    Output: generator of spaCy docs, in the same order as the texts, yielded as each batch finishes
+    """
+    if batch_size is None:
+        batch_size = spacy_batch_size
+    if n_process is None:
+        n_process = spacy_n_process
+
+    yield from nlp_model.get().pipe(texts, batch_size=batch_size, n_process=n_process)
+
+
+def report_spacy_timings(texts):
+    """
+    Print how long each spaCy component takes on a set of pages, to compare pipeline profiles.
+
+    Input: list of plain texts
+    Output: A print out to the terminal of seconds per component
+    """
+    timings = time_pipeline_components(nlp_model.get(), texts, batch_size=spacy_batch_size)
+    total = sum(timings.values())
+
+    print(f"        spaCy profile '{spacy_profile}' on {len(texts)} pages: {total:.2f}s")
+    for name, seconds in timings.items():
+        print(f"            {name:<16} {seconds:.2f}s ({seconds / total * 100 if total else 0:.0f}%)")
+
+
 def get_entity_type(desired_type):
     """
     Mapping function that takes the user imputted extraction type  and transforms it into the
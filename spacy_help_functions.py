@@ -8,6 +8,8 @@ This file was largely provided by the course staff, with minor modifications out
 
 # Environment Set Up
 import spacy
+import json
+import time
 from collections import defaultdict
 
 spacy2bert = { 
@@ -29,6 +31,68 @@ bert2spacy = {
         }
 
 
+# spaCy pipeline profiles. Extraction only reads .ents, .sents and token.is_punct, so the tagger,
+# attribute ruler and lemmatizer are never needed.
+#  - full:       every default component of the model
+#  - ner_parser: NER + dependency parser for sentence boundaries (same sentences and entities as full)
+#  - ner_senter: NER + the much lighter senter for sentence boundaries (boundaries may differ slightly from the parser)
+SPACY_PROFILES = {
+    "full": {"exclude": [], "enable": []},
+    "ner_parser": {"exclude": ["tagger", "attribute_ruler", "lemmatizer"], "enable": []},
+    "ner_senter": {"exclude": ["tagger", "attribute_ruler", "lemmatizer", "parser"], "enable": ["senter"]},
+}
+
+
+def load_spacy_pipeline(model="en_core_web_lg", profile="ner_parser"):
+    """
+    Load a spaCy model with only the components a profile needs.
+
+    Input: spaCy model name, profile name from SPACY_PROFILES
+    Output: spaCy Language object
+    """
+    if profile not in SPACY_PROFILES:
+        raise ValueError("Unknown spaCy profile '{}'. Choose one of: {}".format(profile, ", ".join(SPACY_PROFILES)))
+    settings = SPACY_PROFILES[profile]
+
+    nlp = spacy.load(model, exclude=settings["exclude"])
+    for name in settings["enable"]:
+        if name in nlp.disabled:
+            nlp.enable_pipe(name)
+
+    # tok2vec only feeds the components listening to it; skip it if none of them are left
+    if "tok2vec" in nlp.pipe_names:
+        listeners = nlp.get_pipe("tok2vec").listening_components
+        if not any(name in nlp.pipe_names for name in listeners):
+            nlp.disable_pipe("tok2vec")
+
+    return nlp
+
+
+def time_pipeline_components(nlp, texts, batch_size=16):
+    """
+    Run texts through a spaCy pipeline one component at a time and time each component.
+
+    Input: spaCy Language object, list of plain texts, batch size
+    Output: dictionary of component name -> seconds (the tokenizer included)
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    docs = [nlp.make_doc(text) for text in texts]
+    timings["tokenizer"] = time.perf_counter() - start
+
+    # nlp.pipeline only lists enabled components
+    for name, component in nlp.pipeline:
+        start = time.perf_counter()
+        if hasattr(component, "pipe"):
+            docs = list(component.pipe(docs, batch_size=batch_size))
+        else:
+            docs = [component(doc) for doc in docs]
+        timings[name] = time.perf_counter() - start
+
+    return timings
+
+
 def get_entities(sentence, entities_of_interest):
     """
     Get entities of interest from a spacy processed sentence. Use spacy2bert to map entity naming conventions
@@ -38,6 +102,62 @@ def get_entities(sentence, entities_of_interest):
     """
     return [spacy2bert.get(e.label_,"OTHER") for e in sentence.ents if spacy2bert.get(e.label_,"OTHER") in entities_of_interest]
 
+def sentence_examples(sentence, entities_of_interest):
+    """
+    Build the SpanBERT candidate examples of one sentence: both directions of every entity pair, keeping only
+    the ones whose subject and object types match the desired relation.
+
+    Input: A spacy processed sentence and a list of entities of interest
+    Output: list of examples for spanbert.predict()
+    """
+    entity_pairs = create_entity_pairs(sentence, entities_of_interest)
+
+    examples = []
+    for ep in entity_pairs:
+        examples.append({"tokens": ep[0], "subj": ep[1], "obj": ep[2]})
+        examples.append({"tokens": ep[0], "subj": ep[2], "obj": ep[1]})
+
+    # remove non required entities
+    return [ex for ex in examples if ex['subj'][1] == entities_of_interest[0] and ex['obj'][1] == entities_of_interest[1]]
+
+
+class PredictionBatcher:
+    """
+    Collects candidate examples from many sentences (and pages) so SpanBERT runs on full batches instead of
+    one small predict() call per sentence, then maps the predictions back to the sentence they came from.
+    """
+
+    def __init__(self):
+        self.examples = []
+        self.spans = {}
+
+    def add(self, key, examples):
+        """
+        Queue the examples of one sentence.
+
+        Input: key identifying the sentence, list of examples
+        Output: N/A
+        """
+        start = len(self.examples)
+        self.examples.extend(examples)
+        self.spans[key] = (start, len(self.examples))
+
+    def predict(self, spanbert, example_log=None, relations=None, normalization="exact"):
+        """
+        Run every queued example through SpanBERT in one call.
+
+        Input: SpanBERT model, optional path of a JSON lines file the examples are appended to,
+               optional relations to score (see SpanBERT.predict) and their normalization
+        Output: dictionary of key -> list of (relation, confidence) for that sentence's examples, in order
+        """
+        if example_log is not None:
+            with open(example_log, "a", encoding="utf-8") as f:
+                for ex in self.examples:
+                    f.write(json.dumps(ex) + "\n")
+        preds = spanbert.predict(self.examples, relations, normalization) if self.examples else []
+        return {key: preds[start:end] for key, (start, end) in self.spans.items()}
+
+
 def extract_relations(doc, spanbert, conf, entities_of_interest=None,relations_of_interest=None):
     """
     Preforms the relation extraction for the spanBERT model. As the program iterates through sentences, it will print to the terminal to keep the user updated on progress.
@@ -45,7 +165,54 @@ def extract_relations(doc, spanbert, conf, entities_of_interest=None,relations_o
     Input: A spacy processed document (in our case, processed plain text scrapped from websites)
     Output: Relationship Tuples
     """
-    num_sentences = len([s for s in doc.sents])
+    return next(extract_relations_batch([doc], spanbert, conf, entities_of_interest, relations_of_interest))
+
+
+def extract_relations_batch(docs, spanbert, conf, entities_of_interest=None, relations_of_interest=None, example_log=None,
+                            label_pruning=None):
+    """
+    Relation extraction for several spacy processed documents (e.g. all pages of an iteration) with a single
+    batched SpanBERT pass. Candidate pairs of every sentence of every document are predicted together before the
+    first document is reported, then each document is reported exactly as extract_relations() does.
+
+    With label_pruning ("exact" or "subset"), SpanBERT only scores no_relation and the relations of interest.
+    "exact" keeps every label and confidence the report uses identical to scoring all labels; "subset"
+    renormalizes over the scored labels, so confidences (and which pairs pass conf) can change.
+
+    Input: list of spacy processed documents, SpanBERT model, confidence threshold, entities and relations of interest,
+           optional JSON lines file collecting every candidate pair (e.g. for spanbert_distill.py), label pruning mode
+    Output: generator of relationship tuples (one defaultdict per document, in order)
+    """
+    # collect the candidate pairs of every sentence of every document
+    batcher = PredictionBatcher()
+    doc_sentences = []
+    for doc_index, doc in enumerate(docs):
+        sentences = list(doc.sents)
+        doc_sentences.append(sentences)
+        for sentence_index, sentence in enumerate(sentences):
+            examples = sentence_examples(sentence, entities_of_interest)
+            if examples:
+                batcher.add((doc_index, sentence_index), examples)
+
+    if label_pruning and relations_of_interest:
+        preds = batcher.predict(spanbert, example_log, relations_of_interest, label_pruning)
+    else:
+        preds = batcher.predict(spanbert, example_log)
+
+    for doc_index, sentences in enumerate(doc_sentences):
+        yield report_relations(sentences, doc_index, batcher, preds, conf, relations_of_interest)
+
+
+def report_relations(sentences, doc_index, batcher, preds, conf, relations_of_interest):
+    """
+    Go through the sentences of one document with their SpanBERT predictions, printing progress and keeping
+    the relations of interest above the confidence threshold.
+
+    Input: sentences of the document, its index in the batch, the PredictionBatcher and its predictions,
+           confidence threshold, relations of interest
+    Output: Relationship Tuples
+    """
+    num_sentences = len(sentences)
     print(f"        Extracted {num_sentences} sentences. Processing each sentence one by one to check for presence of right pair of named entity types; if so, will run the second pipeline ...")
 
     # initialize sentence processed counter
@@ -59,30 +226,21 @@ def extract_relations(doc, spanbert, conf, entities_of_interest=None,relations_o
 
     res = defaultdict(int)
     
-    for sentence in doc.sents:
+    for sentence_index, sentence in enumerate(sentences):
         # check if the sentence has been annotated or not
         have_annotate_sentence = False
         processed_sentence_counter += 1 
         if processed_sentence_counter % 5 == 0:
                 print(f"        Processed {min(processed_sentence_counter, num_sentences)} / {num_sentences} sentences")
 
-       
-        entity_pairs = create_entity_pairs(sentence, entities_of_interest)
-
-        examples = []
-        for ep in entity_pairs:
-            examples.append({"tokens": ep[0], "subj": ep[1], "obj": ep[2]})
-            examples.append({"tokens": ep[0], "subj": ep[2], "obj": ep[1]})
-
-        # remove non required entities
-        examples = [ex for ex in examples if ex['subj'][1] == entities_of_interest[0] and ex['obj'][1] == entities_of_interest[1]]
-        
         # check if there is any entity pairs, if not then continue to next sentence
-        if not examples:      
+        key = (doc_index, sentence_index)
+        if key not in batcher.spans:
             continue
 
-        preds = spanbert.predict(examples)
-        for ex, pred in list(zip(examples, preds)):
+        start, end = batcher.spans[key]
+        examples = batcher.examples[start:end]
+        for ex, pred in list(zip(examples, preds[key])):
             relation = pred[0]
             if relation == 'no_relation':
                 continue
@@ -5,17 +5,21 @@ Scripts adopted from https://github.com/facebookresearch/SpanBERT and edited by
 """
 
 import os
+import io
+import sys
+import copy
 import random
 import time
 import json
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, TensorDataset
 #from transformers import AutoTokenizer, AutoModel, BertForSequenceClassification
-from pytorch_pretrained_bert.modeling import BertForSequenceClassification
+from pytorch_pretrained_bert.modeling import BertForSequenceClassification, BertEarlyExitHeads, BertLabelSubset
 from pytorch_pretrained_bert.tokenization import BertTokenizer
-from scipy.special import softmax
+
+# Early exit heads of a checkpoint, written by "spanbert_distill.py early-exit"
+EARLY_EXIT_HEADS = "early_exit_heads.bin"
 
 CLS = "[CLS]"
 SEP = "[SEP]"
@@ -29,8 +33,28 @@ label_list = ['no_relation', 'per:title', 'org:top_members/employees', 'per:empl
               'org:shareholders', 'org:number_of_employees/members', 'per:charges', 'per:city_of_birth', 'per:date_of_birth', 
               'per:religion', 'per:stateorprovince_of_death', 'per:stateorprovince_of_birth', 'per:country_of_birth', 'org:dissolved',
               'per:country_of_death']
+# Label reported with relations_of_interest when a relation outside them wins (its logit is not computed)
+OTHER_RELATION = "other_relation"
+# Normalizations of the restricted classifier output (see SpanBERT.predict): the full softmax, or the softmax
+# over no_relation and the relations of interest only
+NORMALIZATIONS = ("exact", "subset")
 special_tokens = {'SUBJ_START': '[unused1]', 'SUBJ_END': '[unused2]', 'OBJ_START': '[unused3]', 'OBJ_END': '[unused4]', 'SUBJ=PERSON': '[unused5]', 'OBJ=TITLE': '[unused6]', 'OBJ=PERSON': '[unused7]', 'OBJ=CITY': '[unused8]', 'SUBJ=ORGANIZATION': '[unused9]', 'OBJ=DATE': '[unused10]', 'OBJ=MISC': '[unused11]', 'OBJ=ORGANIZATION': '[unused12]', 'OBJ=NATIONALITY': '[unused13]', 'OBJ=NUMBER': '[unused14]', 'OBJ=RELIGION': '[unused15]', 'OBJ=URL': '[unused16]', 'OBJ=CAUSE_OF_DEATH': '[unused17]', 'OBJ=COUNTRY': '[unused18]', 'OBJ=DURATION': '[unused19]', 'OBJ=STATE_OR_PROVINCE': '[unused20]', 'OBJ=LOCATION': '[unused21]', 'OBJ=CRIMINAL_CHARGE': '[unused22]', 'OBJ=IDEOLOGY': '[unused23]'} 
 
+# Input encodings of upstream SpanBERT (run_tacred.py --feature_mode). The pretrained TACRED classifier was
+# fine-tuned with "ner": entity spans are replaced by their SUBJ=/OBJ= type token.
+ENCODING_MODES = ("ner", "text", "text_ner", "ner_text")
+
+# Expected encodings of "Bill Gates is the founder of Microsoft" (subj: Bill Gates/PERSON, obj: Microsoft/ORGANIZATION)
+REFERENCE_EXAMPLE = {"tokens": "Bill Gates is the founder of Microsoft".split(),
+                     "subj": ('Bill Gates', "PERSON", (0, 1)), "obj": ('Microsoft', "ORGANIZATION", (6, 6))}
+REFERENCE_ENCODINGS = {
+    "ner": "[CLS] [unused5] is the founder of [unused12] [SEP]",
+    "text": "[CLS] [unused1] Bill Gates [unused2] is the founder of [unused3] Microsoft [unused4] [SEP]",
+    "text_ner": "[CLS] [unused1] Bill Gates [unused2] is the founder of [unused3] Microsoft [unused4] [SEP] [unused5] [SEP] [unused12] [SEP]",
+    "ner_text": "[CLS] [unused5] is the founder of [unused12] [SEP] Bill Gates [SEP] Microsoft [SEP]",
+}
+
+
 class InputExample(object):
     """A single training/test example for span pair classification."""
 
@@ -51,61 +75,101 @@ class InputFeatures(object):
         self.segment_ids = segment_ids
 
 
-def convert_examples_to_features(examples, max_seq_length, tokenizer, special_tokens):
-    """Loads a data file into a list of `InputBatch`s."""
-
-    def create_examples(dataset):
-        """Creates examples for the training and dev sets."""
-        examples = []
-        for example in dataset:
-            sentence = example['tokens']
-            examples.append(InputExample(
-                sentence=example['tokens'],
-                ner1=example['subj'][1],
-                span1=example['subj'][2],
-                ner2=example['obj'][1],
-                span2=example['obj'][2]
-                ))
-        return examples
-
-    def get_special_token(w):
-        if w not in special_tokens:
-            raise(BaseException("ERROR: did not find special token {} in current dict: {}\n".format(w, special_tokens.keys())))
-            #special_tokens[w] = "[unused%d]" % (len(special_tokens) + 1)
-        return special_tokens[w]
+def create_examples(dataset):
+    """Creates examples for the training and dev sets."""
+    examples = []
+    for example in dataset:
+        examples.append(InputExample(
+            sentence=example['tokens'],
+            ner1=example['subj'][1],
+            span1=example['subj'][2],
+            ner2=example['obj'][1],
+            span2=example['obj'][2]
+            ))
+    return examples
 
-    examples = create_examples(examples)
-    num_tokens = 0
-    num_fit_examples = 0
-    num_shown_examples = 0
-    features = []
-    for (ex_index, example) in enumerate(examples):
-        tokens = [CLS]
-        SUBJECT_START = get_special_token("SUBJ_START")
-        SUBJECT_END = get_special_token("SUBJ_END")
-        OBJECT_START = get_special_token("OBJ_START")
-        OBJECT_END = get_special_token("OBJ_END")
-        SUBJECT_NER = get_special_token("SUBJ=%s" % example.ner1)
-        OBJECT_NER = get_special_token("OBJ=%s" % example.ner2)
-
-        subj_tokens = []
-        obj_tokens = []
+
+def get_special_token(w, special_tokens):
+    if w not in special_tokens:
+        raise(BaseException("ERROR: did not find special token {} in current dict: {}\n".format(w, special_tokens.keys())))
+    return special_tokens[w]
+
+
+def encode_example(example, tokenizer, special_tokens, mode="ner"):
+    """Builds the (untruncated) token sequence of one InputExample in the given encoding mode.
+    "legacy" is the encoding used before the encoder was fixed (context sub-tokens doubled, [SEP] after every
+    word, spans dropped); it is only kept so encoding_benchmark() can compare against it."""
+    tokens = [CLS]
+    SUBJECT_START = get_special_token("SUBJ_START", special_tokens)
+    SUBJECT_END = get_special_token("SUBJ_END", special_tokens)
+    OBJECT_START = get_special_token("OBJ_START", special_tokens)
+    OBJECT_END = get_special_token("OBJ_END", special_tokens)
+    SUBJECT_NER = get_special_token("SUBJ=%s" % example.ner1, special_tokens)
+    OBJECT_NER = get_special_token("OBJ=%s" % example.ner2, special_tokens)
+
+    if mode == "legacy":
         for i, token in enumerate(example.sentence):
             if i == example.span1[0]:
                 tokens.append(SUBJECT_NER)
             if i == example.span2[0]:
                 tokens.append(OBJECT_NER)
-            if (i >= example.span1[0]) and (i <= example.span1[1]):
-                for sub_token in tokenizer.tokenize(token):
-                    subj_tokens.append(sub_token)
-            elif (i >= example.span2[0]) and (i <= example.span2[1]):
-                for sub_token in tokenizer.tokenize(token):
-                    obj_tokens.append(sub_token)
-            else:
+            if not (example.span1[0] <= i <= example.span1[1] or example.span2[0] <= i <= example.span2[1]):
                 for sub_token in tokenizer.tokenize(token):
                     tokens.append(sub_token)
                     tokens.append(sub_token)
             tokens.append(SEP)
+        return tokens
+
+    if mode.startswith("text"):
+        # mark the spans and keep their words
+        for i, token in enumerate(example.sentence):
+            if i == example.span1[0]:
+                tokens.append(SUBJECT_START)
+            if i == example.span2[0]:
+                tokens.append(OBJECT_START)
+            tokens.extend(tokenizer.tokenize(token))
+            if i == example.span1[1]:
+                tokens.append(SUBJECT_END)
+            if i == example.span2[1]:
+                tokens.append(OBJECT_END)
+        if mode == "text_ner":
+            tokens += [SEP, SUBJECT_NER, SEP, OBJECT_NER, SEP]
+        else:
+            tokens.append(SEP)
+        return tokens
+
+    # replace each span by its entity type token
+    subj_tokens = []
+    obj_tokens = []
+    for i, token in enumerate(example.sentence):
+        if i == example.span1[0]:
+            tokens.append(SUBJECT_NER)
+        if i == example.span2[0]:
+            tokens.append(OBJECT_NER)
+        if (i >= example.span1[0]) and (i <= example.span1[1]):
+            subj_tokens.extend(tokenizer.tokenize(token))
+        elif (i >= example.span2[0]) and (i <= example.span2[1]):
+            obj_tokens.extend(tokenizer.tokenize(token))
+        else:
+            tokens.extend(tokenizer.tokenize(token))
+    if mode == "ner_text":
+        tokens += [SEP] + subj_tokens + [SEP] + obj_tokens
+    tokens.append(SEP)
+    return tokens
+
+
+def convert_examples_to_features(examples, max_seq_length, tokenizer, special_tokens, pad_to_max_length=True, mode="ner"):
+    """Loads a data file into a list of `InputBatch`s.
+    With pad_to_max_length=False features keep their own length and are padded per batch by `make_batches`."""
+    if mode not in ENCODING_MODES:
+        raise ValueError("Unknown encoding mode {}, expected one of {}".format(mode, ENCODING_MODES))
+
+    examples = create_examples(examples)
+    num_tokens = 0
+    num_fit_examples = 0
+    features = []
+    for (ex_index, example) in enumerate(examples):
+        tokens = encode_example(example, tokenizer, special_tokens, mode)
         num_tokens += len(tokens)
 
         if len(tokens) > max_seq_length:
@@ -116,14 +180,15 @@ def convert_examples_to_features(examples, max_seq_length, tokenizer, special_to
         segment_ids = [0] * len(tokens)
         input_ids = tokenizer.convert_tokens_to_ids(tokens)
         input_mask = [1] * len(input_ids)
-        padding = [0] * (max_seq_length - len(input_ids))
-        input_ids += padding
-        input_mask += padding
-        segment_ids += padding
+        if pad_to_max_length:
+            padding = [0] * (max_seq_length - len(input_ids))
+            input_ids += padding
+            input_mask += padding
+            segment_ids += padding
 
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
+            assert len(input_ids) == max_seq_length
+            assert len(input_mask) == max_seq_length
+            assert len(segment_ids) == max_seq_length
 
         features.append(
                 InputFeatures(input_ids=input_ids,
@@ -136,35 +201,240 @@ def convert_examples_to_features(examples, max_seq_length, tokenizer, special_to
     return features
 
 
-def predict(model, device, eval_dataloader, verbose=True):
+def validate_encodings(tokenizer, special_tokens=special_tokens):
+    """Checks every encoding mode against REFERENCE_ENCODINGS. Raises AssertionError on a mismatch."""
+    example = create_examples([REFERENCE_EXAMPLE])[0]
+    for mode, expected in REFERENCE_ENCODINGS.items():
+        encoded = " ".join(encode_example(example, tokenizer, special_tokens, mode))
+        assert encoded == expected, "{} encoding is\n  {}\nexpected\n  {}".format(mode, encoded, expected)
+
+
+def encoding_benchmark(examples, tokenizer, max_seq_length=128, special_tokens=special_tokens):
+    """Prints the average number of tokens per example and the share of examples that fit max_seq_length,
+    for the legacy encoding and every encoding mode."""
+    examples = create_examples(examples)
+    print("{:<10} {:>14} {:>12} {:>8}".format("mode", "tokens/example", "fit {}".format(max_seq_length), "time"))
+    for mode in ("legacy",) + ENCODING_MODES:
+        start = time.time()
+        lengths = [len(encode_example(example, tokenizer, special_tokens, mode)) for example in examples]
+        elapsed = time.time() - start
+        fit = sum(length <= max_seq_length for length in lengths)
+        print("{:<10} {:>14.1f} {:>11.1f}% {:>7.3f}s".format(mode, sum(lengths) / len(lengths),
+                                                             fit * 100.0 / len(lengths), elapsed))
+
+
+def make_batches(features, batch_size, max_seq_length, pad_multiple=8):
+    """Groups unpadded features into length-sorted batches, each padded only to the shortest multiple of
+    pad_multiple that fits its longest sequence (capped at max_seq_length). Attention cost grows with the
+    square of the sequence length, so short candidate windows no longer pay for 128 positions.
+    Returns the batches as (input_ids, input_mask, segment_ids) tensors and the order of the features in them."""
+    order = sorted(range(len(features)), key=lambda i: len(features[i].input_ids))
+    batches = []
+    for start in range(0, len(order), batch_size):
+        batch = [features[i] for i in order[start:start + batch_size]]
+        longest = max(len(f.input_ids) for f in batch)
+        seq_length = min(max_seq_length, -(-longest // pad_multiple) * pad_multiple)
+
+        def pad(values):
+            return values + [0] * (seq_length - len(values))
+
+        batches.append((torch.tensor([pad(f.input_ids) for f in batch], dtype=torch.long),
+                        torch.tensor([pad(f.input_mask) for f in batch], dtype=torch.long),
+                        torch.tensor([pad(f.segment_ids) for f in batch], dtype=torch.long)))
+    return batches, order
+
+
+def predict(model, device, eval_dataloader, verbose=True, label_subset=None):
+    """Runs the batches through the model. Logits stay on the device and are concatenated once at the end;
+    the label and its softmax probability are computed in torch, so only the two result vectors are copied
+    back to the host. With a BertLabelSubset only its columns are scored (the classifier computes them
+    directly; a runtime backend's full logits are restricted afterwards), and labels outside the subset come
+    back as -1."""
     model.eval()
-    preds = []
-    for input_ids, input_mask, segment_ids in eval_dataloader:
-        input_ids = input_ids.to(device)
-        input_mask = input_mask.to(device)
-        segment_ids = segment_ids.to(device)
-        with torch.no_grad():
-            logits = model(input_ids, segment_ids, input_mask, labels=None)
-        if len(preds) == 0:
-            preds.append(logits.detach().cpu().numpy())
+    batch_logits = []
+    with torch.inference_mode():
+        for input_ids, input_mask, segment_ids in eval_dataloader:
+            input_ids = input_ids.to(device)
+            input_mask = input_mask.to(device)
+            segment_ids = segment_ids.to(device)
+            if label_subset is None:
+                batch_logits.append(model(input_ids, segment_ids, input_mask))
+            elif isinstance(model, BertForSequenceClassification):
+                batch_logits.append(model(input_ids, segment_ids, input_mask, label_subset=label_subset))
+            else:
+                batch_logits.append(label_subset.restrict(model(input_ids, segment_ids, input_mask).to(device)))
+
+        if not batch_logits:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        # softmax in fp32 even when the model runs in half precision
+        logits = torch.cat(batch_logits).float()
+        if label_subset is None:
+            pred_proba, pred_ids = torch.softmax(logits, dim=1).max(dim=1)
         else:
-            preds[0] = np.append(
-                preds[0], logits.detach().cpu().numpy(), axis=0)
+            pred_ids, pred_proba = decode_subset(logits, label_subset)
+    return pred_ids.cpu().numpy(), pred_proba.cpu().numpy()
+
+
+def decode_subset(logits, label_subset):
+    """Label ids and confidences from BertLabelSubset output columns. In exact mode the confidence is the
+    full softmax probability of the winning label, and the label is the full argmax whenever that is a kept
+    label (-1 otherwise), so relations of interest are ranked exactly as with every logit."""
+    keep = torch.tensor(label_subset.keep, dtype=torch.long, device=logits.device)
+    if not label_subset.exact:
+        pred_proba, columns = torch.softmax(logits, dim=1).max(dim=1)
+        return keep[columns], pred_proba
+
+    # columns: kept logits, then the largest and the logsumexp of the other logits
+    num_kept = len(label_subset.keep)
+    log_normalizer = torch.cat([logits[:, :num_kept], logits[:, num_kept + 1:]], dim=1).logsumexp(dim=1, keepdim=True)
+    pred_proba, columns = (logits[:, :num_kept + 1] - log_normalizer).exp().max(dim=1)
+    return torch.cat([keep, keep.new_tensor([-1])])[columns], pred_proba
+
+
+def _eval_example(sentence, subj, subj_type, obj, obj_type):
+    """Builds an example from a sentence and the (first, last) word indices of its subject and object."""
+    tokens = sentence.split()
+    return {"tokens": tokens,
+            "subj": (" ".join(tokens[subj[0]:subj[1] + 1]), subj_type, subj),
+            "obj": (" ".join(tokens[obj[0]:obj[1] + 1]), obj_type, obj)}
+
+
+# Fixed evaluation set used to compare faster variants of the classifier (quantized, exported, ...) with the
+# fp32 model. Covers the four relations the program extracts, in both directions, plus unrelated pairs.
+EVALUATION_EXAMPLES = [
+    _eval_example("Bill Gates is the founder of Microsoft", (0, 1), "PERSON", (6, 6), "ORGANIZATION"),
+    _eval_example("Bill Gates is the founder of Microsoft", (6, 6), "ORGANIZATION", (0, 1), "PERSON"),
+    _eval_example("Sundar Pichai is the chief executive officer of Google", (0, 1), "PERSON", (8, 8), "ORGANIZATION"),
+    _eval_example("Sundar Pichai is the chief executive officer of Google", (8, 8), "ORGANIZATION", (0, 1), "PERSON"),
+    _eval_example("Jeff Bezos founded Amazon in 1994 in Seattle", (0, 1), "PERSON", (3, 3), "ORGANIZATION"),
+    _eval_example("Jeff Bezos founded Amazon in 1994 in Seattle", (3, 3), "ORGANIZATION", (7, 7), "CITY"),
+    _eval_example("Jeff Bezos founded Amazon in 1994 in Seattle", (0, 1), "PERSON", (7, 7), "CITY"),
+    _eval_example("Mark Zuckerberg attended Harvard University before starting Facebook", (0, 1), "PERSON", (3, 4), "ORGANIZATION"),
+    _eval_example("Mark Zuckerberg attended Harvard University before starting Facebook", (0, 1), "PERSON", (7, 7), "ORGANIZATION"),
+    _eval_example("Larry Page graduated from Stanford University and the University of Michigan", (0, 1), "PERSON", (4, 5), "ORGANIZATION"),
+    _eval_example("Larry Page graduated from Stanford University and the University of Michigan", (0, 1), "PERSON", (8, 10), "ORGANIZATION"),
+    _eval_example("Sheryl Sandberg worked at Google before joining Facebook as chief operating officer", (0, 1), "PERSON", (4, 4), "ORGANIZATION"),
+    _eval_example("Sheryl Sandberg worked at Google before joining Facebook as chief operating officer", (0, 1), "PERSON", (7, 7), "ORGANIZATION"),
+    _eval_example("Satya Nadella lives in Bellevue , Washington with his family", (0, 1), "PERSON", (4, 4), "CITY"),
+    _eval_example("Satya Nadella lives in Bellevue , Washington with his family", (0, 1), "PERSON", (6, 6), "STATE_OR_PROVINCE"),
+    _eval_example("Tim Cook , who grew up in Alabama , is the CEO of Apple", (0, 1), "PERSON", (7, 7), "STATE_OR_PROVINCE"),
+    _eval_example("Tim Cook , who grew up in Alabama , is the CEO of Apple", (0, 1), "PERSON", (13, 13), "ORGANIZATION"),
+    _eval_example("Tim Cook , who grew up in Alabama , is the CEO of Apple", (13, 13), "ORGANIZATION", (0, 1), "PERSON"),
+    _eval_example("Elon Musk moved from South Africa to Canada and later to the United States", (0, 1), "PERSON", (4, 5), "COUNTRY"),
+    _eval_example("Elon Musk moved from South Africa to Canada and later to the United States", (0, 1), "PERSON", (7, 7), "COUNTRY"),
+    _eval_example("Susan Wojcicki met Sergey Brin when Google rented her garage", (0, 1), "PERSON", (3, 4), "PERSON"),
+    _eval_example("Susan Wojcicki met Sergey Brin when Google rented her garage", (0, 1), "PERSON", (6, 6), "ORGANIZATION"),
+    _eval_example("Columbia University announced that Lee Bollinger will step down as president", (0, 1), "ORGANIZATION", (4, 5), "PERSON"),
+    _eval_example("Columbia University announced that Lee Bollinger will step down as president", (4, 5), "PERSON", (0, 1), "ORGANIZATION"),
+]
+
+
+def evenly_spaced_layers(total, keep):
+    """Indices of `keep` encoder layers spread evenly over `total`, always including the last one
+    (e.g. 24 -> 12 keeps layers 1, 3, ..., 23)."""
+    return [round((i + 1) * total / keep) - 1 for i in range(keep)]
+
+
+def load_examples(path):
+    """Reads examples ({"tokens", "subj", "obj"}) from a JSON list or a JSON lines file."""
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
 
-    pred_ids = np.argmax(preds[0], axis=1)
-    pred_proba = np.max(softmax(preds[0], axis=1), axis=1)
-    return pred_ids, pred_proba
+
+def model_size_bytes(model):
+    """Size of the serialized weights of a model (int8 weights of a quantized model are packed, so they are
+    not counted by summing parameter sizes)."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def runner_size_bytes(bert):
+    """Size of the weights a SpanBERT instance actually runs: the exported file of an ONNX Runtime session,
+    the serialized module otherwise (eager or TorchScript). None if it cannot be measured."""
+    path = getattr(bert.runner, "path", None)
+    if path is not None:
+        return os.path.getsize(path) if os.path.exists(path) else None
+    if isinstance(bert.runner, torch.jit.ScriptModule):
+        # A frozen module keeps its weights as constants, outside its state_dict
+        buffer = io.BytesIO()
+        torch.jit.save(bert.runner, buffer)
+        return buffer.getbuffer().nbytes
+    if hasattr(bert.runner, "state_dict"):
+        return model_size_bytes(bert.runner)
+    return None
+
+
+def quantize_dynamic_int8(model):
+    """Returns a copy of the classifier whose nn.Linear layers (attention projections, feed-forward layers,
+    pooler and classifier, nearly all of BERT's weights and compute) use int8 weights, with activations
+    quantized on the fly. CPU only."""
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def compare_models(reference, candidate, examples=None, conf=0.7):
+    """Runs the same examples through two SpanBERT instances and prints how far the candidate's predictions
+    are from the reference's: label agreement, agreement on the relations that would be kept (not
+    no_relation and confidence above conf), confidence differences, speed and weight size.
+    Returns the numbers as a dictionary."""
+    examples = EVALUATION_EXAMPLES if examples is None else examples
+    results = {}
+    for name, bert in (("reference", reference), ("candidate", candidate)):
+        bert.predict(examples[:1])  # warm up
+        bert.early_exit_report()  # only count the timed pass
+        start = time.time()
+        preds = bert.predict(examples)
+        results[name] = (preds, time.time() - start)
+        early_exit = bert.early_exit_report()
+        if early_exit is not None:
+            print("  {}: {}".format(name, early_exit))
+
+    ref_preds, ref_time = results["reference"]
+    cand_preds, cand_time = results["candidate"]
+
+    def kept(pred):
+        return pred[0] if pred[0] != "no_relation" and pred[1] > conf else None
+
+    stats = {
+        "examples": len(examples),
+        "label_agreement": sum(r[0] == c[0] for r, c in zip(ref_preds, cand_preds)) / len(examples),
+        "kept_agreement": sum(kept(r) == kept(c) for r, c in zip(ref_preds, cand_preds)) / len(examples),
+        "max_conf_delta": max(abs(float(r[1]) - float(c[1])) for r, c in zip(ref_preds, cand_preds)),
+        "mean_conf_delta": sum(abs(float(r[1]) - float(c[1])) for r, c in zip(ref_preds, cand_preds)) / len(examples),
+        "reference_seconds": ref_time,
+        "candidate_seconds": cand_time,
+        "reference_bytes": runner_size_bytes(reference),
+        "candidate_bytes": runner_size_bytes(candidate),
+    }
+    print("Evaluated {} examples".format(stats["examples"]))
+    print("  label agreement:         {:.1%}".format(stats["label_agreement"]))
+    print("  kept relation agreement: {:.1%} (confidence > {})".format(stats["kept_agreement"], conf))
+    print("  confidence delta:        max {:.4f}, mean {:.4f}".format(stats["max_conf_delta"], stats["mean_conf_delta"]))
+    print("  time:                    {:.2f}s -> {:.2f}s ({:.2f}x)".format(ref_time, cand_time, ref_time / max(cand_time, 1e-9)))
+    if stats["reference_bytes"] is not None and stats["candidate_bytes"] is not None:
+        print("  weights:                 {:.1f} MB -> {:.1f} MB".format(stats["reference_bytes"] / 2 ** 20, stats["candidate_bytes"] / 2 ** 20))
+    return stats
 
 
 class SpanBERT:
-    def __init__(self, pretrained_dir, model="spanbert-base-cased"):
+    def __init__(self, pretrained_dir, model="spanbert-base-cased", quantize=False, backend="torch", packed=False,
+                 num_layers=None, early_exit=False):
         assert os.path.exists(pretrained_dir), "Pre-trained model folder does not exist: {}".format(pretrained_dir)
         self.seed = 42
         self.max_seq_length = 128
         self.batch_size = 32
+        # batches are padded to a multiple of this instead of max_seq_length
+        self.pad_multiple = 8
+        # input encoding the pretrained classifier was fine-tuned with (see ENCODING_MODES)
+        self.encoding_mode = "ner"
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.n_gpu = torch.cuda.device_count()
         self.fp16 = self.n_gpu > 0
+        # int8 dynamic quantization is a CPU optimization; on a GPU the model runs in fp16 instead
+        self.quantized = quantize and not self.fp16
         self._set_seed()
         self.label2id = {label: i for i, label in enumerate(label_list)}
         self.id2label = {i: label for i, label in enumerate(label_list)}
@@ -174,10 +444,39 @@ class SpanBERT:
 
         print("Loading pre-trained spanBERT from {}".format(pretrained_dir))
         self.classifier = BertForSequenceClassification.from_pretrained(pretrained_dir, num_labels=self.num_labels)
+        # smaller tier without distillation: keep num_layers evenly spaced encoder layers
+        if num_layers is not None and num_layers < self.classifier.config.num_hidden_layers:
+            self.classifier.drop_layers(evenly_spaced_layers(self.classifier.config.num_hidden_layers, num_layers))
+        # one Q/K/V projection per layer instead of three (built from the loaded weights)
+        self.classifier.fuse_qkv()
+        # run the encoder layers on real tokens only, not on the padding of each batch
+        self.classifier.enable_packed_inference(packed)
+        # stop confident examples at intermediate layers (heads trained and calibrated by spanbert_distill.py)
+        if early_exit:
+            heads_path = os.path.join(pretrained_dir, EARLY_EXIT_HEADS)
+            if not os.path.exists(heads_path):
+                print("No early exit heads in {}; running all layers".format(pretrained_dir))
+            else:
+                heads = BertEarlyExitHeads.load(heads_path, self.classifier.config, self.num_labels)
+                try:
+                    self.classifier.enable_early_exit(heads)
+                except ValueError as e:
+                    print("{}; running all layers".format(e))
         if self.fp16:
             self.classifier.half()
+        elif self.quantized:
+            self.classifier = quantize_dynamic_int8(self.classifier)
         self.classifier.to(self.device)
 
+        # what predict() runs: the classifier itself, or a faster runtime built from it (spanbert_runtime.py)
+        self.runner = self.classifier
+        if backend == "onnx":
+            from spanbert_runtime import load_onnx_backend
+            load_onnx_backend(self, pretrained_dir)
+        elif backend == "torchscript":
+            from spanbert_runtime import load_torchscript_backend
+            load_torchscript_backend(self, pretrained_dir)
+
     def _set_seed(self):
         random.seed(self.seed)
         np.random.seed(self.seed)
@@ -185,18 +484,82 @@ class SpanBERT:
         if self.n_gpu > 0:
             torch.cuda.manual_seed_all(self.seed)
 
-    def predict(self, examples):
-        features = convert_examples_to_features(examples, self.max_seq_length, self.tokenizer, special_tokens)
-        all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-        data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids)
-        dataloader = DataLoader(data, batch_size=self.batch_size)
-        preds, proba = predict(self.classifier, self.device, dataloader)
-        preds = [self.id2label[pred] for pred in preds]
+    def early_exit_report(self):
+        """Average number of encoder layers run per pair since the last report (None without early exit or
+        without pairs). Resets the counters, so each report covers the pairs predicted since the previous one."""
+        heads = getattr(self.classifier, "early_exit", None)
+        if heads is None:
+            return None
+        pairs = sum(heads.exit_counts)
+        if pairs == 0:
+            return None
+        report = "SpanBERT early exit: {:.1f} of {} layers per pair on average ({} pairs)".format(
+            heads.average_layers(), heads.num_hidden_layers, pairs)
+        heads.reset_exit_counts()
+        return report
+
+    def label_subset(self, relations, normalization="exact"):
+        """Output restricted to no_relation and the given relations, which are also the labels the early
+        exit screen keeps reachable (see NORMALIZATIONS)."""
+        if normalization not in NORMALIZATIONS:
+            raise ValueError("Unknown normalization '{}'. Choose one of: {}".format(normalization, ", ".join(NORMALIZATIONS)))
+        targets = [self.label2id[relation] for relation in relations]
+        return BertLabelSubset([self.label2id["no_relation"]] + targets, screen=targets, exact=normalization == "exact")
+
+    def predict(self, examples, relations=None, normalization="exact"):
+        """Label and confidence of every example. With relations (e.g. the relations of interest), only
+        no_relation and those labels are scored; any other winning label comes back as OTHER_RELATION.
+        normalization="exact" keeps the full model's confidences, "subset" renormalizes over the scored labels."""
+        features = convert_examples_to_features(examples, self.max_seq_length, self.tokenizer, special_tokens,
+                                                pad_to_max_length=False, mode=self.encoding_mode)
+        batches, order = make_batches(features, self.batch_size, self.max_seq_length, self.pad_multiple)
+        label_subset = None if relations is None else self.label_subset(relations, normalization)
+        sorted_preds, sorted_proba = predict(self.runner, self.device, batches, label_subset=label_subset)
+
+        # put the predictions back in the order of the examples
+        preds = [None] * len(order)
+        proba = [None] * len(order)
+        for position, index in enumerate(order):
+            preds[index] = self.id2label.get(sorted_preds[position], OTHER_RELATION)
+            proba[index] = sorted_proba[position]
         return list(zip(preds, proba))
 
 if __name__ == "__main__":
+    # python spanbert.py --benchmark-encoding [examples.json]: compare input lengths of the encodings
+    # (examples.json holds {"tokens", "subj", "obj"} examples as passed to SpanBERT.predict, as a JSON list or JSON lines)
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark-encoding":
+        tokenizer = BertTokenizer.from_pretrained("spanbert-base-cased", do_lower_case=False)
+        validate_encodings(tokenizer)
+        benchmark_examples = [REFERENCE_EXAMPLE]
+        if len(sys.argv) > 2:
+            benchmark_examples = load_examples(sys.argv[2])
+        encoding_benchmark(benchmark_examples, tokenizer)
+        sys.exit(0)
+
+    # python spanbert.py --compare-quantized [examples.json]: accuracy delta of int8 inference against fp32
+    if len(sys.argv) > 1 and sys.argv[1] == "--compare-quantized":
+        reference = SpanBERT(os.path.abspath("./pretrained_spanbert"))
+        candidate = copy.copy(reference)
+        candidate.classifier = quantize_dynamic_int8(reference.classifier)
+        candidate.runner = candidate.classifier
+        evaluation_examples = None
+        if len(sys.argv) > 2:
+            evaluation_examples = load_examples(sys.argv[2])
+        compare_models(reference, candidate, evaluation_examples)
+        sys.exit(0)
+
+    # python spanbert.py --compare-onnx [examples.json]: ONNX Runtime against eager PyTorch
+    if len(sys.argv) > 1 and sys.argv[1] == "--compare-onnx":
+        from spanbert_runtime import load_onnx_backend
+        reference = SpanBERT(os.path.abspath("./pretrained_spanbert"))
+        candidate = copy.copy(reference)
+        if load_onnx_backend(candidate, os.path.abspath("./pretrained_spanbert")):
+            evaluation_examples = None
+            if len(sys.argv) > 2:
+                evaluation_examples = load_examples(sys.argv[2])
+            compare_models(reference, candidate, evaluation_examples)
+        sys.exit(0)
+
     pretrained_dir = os.path.abspath("./pretrained_spanbert")
     bert = SpanBERT(pretrained_dir=pretrained_dir)
     examples = [
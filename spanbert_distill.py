@@ -0,0 +1,400 @@
+"""
+This file builds smaller SpanBERT relation classifiers for bulk crawling and measures what they cost in accuracy.
+A student keeps an evenly spaced subset of the teacher's 24 encoder layers (layer dropping) and is then trained
+to reproduce the teacher's logits on real candidate pairs (distillation). Students are saved as regular
+checkpoint folders, so SpanBERT loads them like the original model.
+
+It also trains the early exit heads of a model (classifiers on intermediate layers, distilled from the model's
+own final logits) and calibrates their confidence threshold so that the relations extraction keeps stay
+within a tolerance of the full-depth model, as well as the screen threshold below which a pair leaves early
+because the relations of interest have become unlikely.
+
+Usage:
+    python3 spanbert_distill.py distill --layers 12 --examples pairs.jsonl [--epochs 3] [--out ./pretrained_spanbert_L12]
+    python3 spanbert_distill.py tradeoff [--students ./pretrained_spanbert_L12 ...] [--layers 6 12] [--examples eval.json]
+    python3 spanbert_distill.py early-exit --examples pairs.jsonl --calibration eval.jsonl [--relations per:employee_of ...]
+                                           [--conf 0.7] [--exit-layers 5 11 17] [--tolerance 0.01]
+
+Candidate pairs for distillation can be collected during normal runs with spanbert_example_log in relation_extraction.py.
+"""
+
+# Environment Set Up
+import argparse
+import copy
+import os
+import random
+
+import torch
+import torch.nn.functional as F
+
+from spanbert import (SpanBERT, EARLY_EXIT_HEADS, compare_models, convert_examples_to_features,
+                      evenly_spaced_layers, load_examples, make_batches, special_tokens)
+from pytorch_pretrained_bert.file_utils import CONFIG_NAME, WEIGHTS_NAME
+from pytorch_pretrained_bert.modeling import BertEarlyExitHeads
+
+
+def make_student(teacher, num_layers):
+    """
+    Build a student classifier by copying the teacher and keeping num_layers evenly spaced encoder layers
+    (embeddings, pooler and classifier are kept as they are).
+
+    Input: teacher SpanBERT (not quantized), number of encoder layers to keep
+    Output: BertForSequenceClassification in fp32 on the teacher's device
+    """
+    student = copy.deepcopy(teacher.classifier).float()
+    total = student.config.num_hidden_layers
+    return student.drop_layers(evenly_spaced_layers(total, num_layers))
+
+
+def make_batches_for(bert, examples):
+    """
+    Encode examples like SpanBERT.predict() does.
+
+    Input: SpanBERT instance, list of examples
+    Output: list of (input_ids, input_mask, segment_ids) batches on the model's device
+    """
+    features = convert_examples_to_features(examples, bert.max_seq_length, bert.tokenizer, special_tokens,
+                                            pad_to_max_length=False, mode=bert.encoding_mode)
+    batches, _ = make_batches(features, bert.batch_size, bert.max_seq_length, bert.pad_multiple)
+    return [tuple(t.to(bert.device) for t in batch) for batch in batches]
+
+
+def kd_loss(logits, target_logits, temperature):
+    """
+    Distillation loss: KL divergence between the temperature-softened target and student distributions.
+
+    Input: student logits, target logits, temperature
+    Output: scalar loss
+    """
+    return F.kl_div(F.log_softmax(logits / temperature, dim=1), F.softmax(target_logits / temperature, dim=1),
+                    reduction="batchmean") * temperature ** 2
+
+
+def distill(teacher, student, examples, epochs=3, learning_rate=5e-5, temperature=2.0, seed=42):
+    """
+    Train the student to match the teacher's output distribution on the given candidate pairs: KL divergence
+    between the temperature-softened softmax of both models (no gold labels needed).
+
+    Input: teacher SpanBERT, student classifier, list of examples, training epochs, AdamW learning rate,
+           softmax temperature, random seed for the batch order
+    Output: the trained student (in eval mode)
+    """
+    batches = make_batches_for(teacher, examples)
+
+    # Teacher logits are fixed, so they are computed once
+    teacher.runner.eval()
+    with torch.inference_mode():
+        targets = [teacher.runner(input_ids, segment_ids, input_mask).float() for input_ids, input_mask, segment_ids in batches]
+
+    optimizer = torch.optim.AdamW(student.parameters(), lr=learning_rate)
+    order = list(range(len(batches)))
+    rng = random.Random(seed)
+    student.train()
+    for epoch in range(epochs):
+        rng.shuffle(order)
+        total_loss = 0.0
+        for index in order:
+            input_ids, input_mask, segment_ids = batches[index]
+            logits = student(input_ids, segment_ids, input_mask)
+            loss = kd_loss(logits, targets[index], temperature)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item()
+        print("Epoch {}/{}: distillation loss {:.4f}".format(epoch + 1, epochs, total_loss / max(len(batches), 1)))
+
+    return student.eval()
+
+
+def save_student(student, out_dir):
+    """
+    Save a student as a checkpoint folder (config.json + pytorch_model.bin) that SpanBERT(out_dir) loads.
+
+    Input: student classifier, output folder
+    Output: N/A
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    student.config.to_json_file(os.path.join(out_dir, CONFIG_NAME))
+    torch.save(student.checkpoint_state_dict(), os.path.join(out_dir, WEIGHTS_NAME))
+    print("Saved {}-layer student to {}".format(student.config.num_hidden_layers, out_dir))
+
+
+def student_spanbert(teacher, student):
+    """
+    Wrap a student classifier in a copy of the teacher's SpanBERT so it can be run and compared.
+
+    Input: teacher SpanBERT, student classifier
+    Output: SpanBERT running the student
+    """
+    bert = copy.copy(teacher)
+    bert.classifier = student.to(teacher.device)
+    if teacher.fp16:
+        bert.classifier.half()
+    bert.runner = bert.classifier
+    return bert
+
+
+def tradeoff_report(teacher, tiers, examples=None, conf=0.7):
+    """
+    Speed/accuracy trade-off of smaller tiers against the full teacher on a fixed set of pairs.
+
+    Input: teacher SpanBERT, list of (name, SpanBERT) tiers, examples (defaults to EVALUATION_EXAMPLES),
+           confidence threshold of the kept relations
+    Output: list of (name, layers, stats from compare_models())
+    """
+    rows = []
+    for name, bert in tiers:
+        print("\n=== {} ===".format(name))
+        rows.append((name, bert.classifier.config.num_hidden_layers, compare_models(teacher, bert, examples, conf)))
+
+    print("\n{:<32} {:>6} {:>9} {:>10} {:>8}".format("tier", "layers", "speed-up", "kept agr.", "labels"))
+    print("{:<32} {:>6} {:>9} {:>10} {:>8}".format("teacher", teacher.classifier.config.num_hidden_layers,
+                                                   "1.00x", "100.0%", "100.0%"))
+    for name, layers, stats in rows:
+        speedup = stats["reference_seconds"] / max(stats["candidate_seconds"], 1e-9)
+        print("{:<32} {:>6} {:>8.2f}x {:>9.1f}% {:>7.1f}%".format(name, layers, speedup,
+                                                                 stats["kept_agreement"] * 100,
+                                                                 stats["label_agreement"] * 100))
+    return rows
+
+
+def full_depth_pass(bert, heads, examples):
+    """
+    Run examples through every layer once, collecting the [CLS] state at each exit layer and the final logits.
+
+    Input: SpanBERT instance (early exit off), BertEarlyExitHeads, list of examples
+    Output: (list per exit layer of [examples, hidden] tensors, [examples, labels] final logits)
+    """
+    classifier = bert.classifier.eval()
+    cls_states = [[] for _ in heads.exit_layers]
+    final_logits = []
+    with torch.inference_mode():
+        for input_ids, input_mask, segment_ids in make_batches_for(bert, examples):
+            encoded_layers, pooled_output = classifier.bert(input_ids, segment_ids, input_mask, output_all_encoded_layers=True)
+            for states, index in zip(cls_states, heads.exit_layers):
+                states.append(encoded_layers[index][:, 0].float())
+            final_logits.append(classifier.classifier(pooled_output).float())
+    return [torch.cat(states) for states in cls_states], torch.cat(final_logits)
+
+
+def train_exit_heads(bert, heads, examples, epochs=5, learning_rate=1e-4, temperature=2.0, batch_size=64, seed=42):
+    """
+    Train early exit heads to predict the model's final logits from intermediate [CLS] states. The encoder is
+    frozen, so its states are computed once and only the small heads are trained.
+
+    Input: SpanBERT instance, BertEarlyExitHeads (fp32), list of examples, training settings
+    Output: the trained heads (in eval mode)
+    """
+    cls_states, final_logits = full_depth_pass(bert, heads, examples)
+    heads.to(final_logits.device)
+    optimizer = torch.optim.AdamW(heads.parameters(), lr=learning_rate)
+    generator = torch.Generator().manual_seed(seed)
+    heads.train()
+    for epoch in range(epochs):
+        order = torch.randperm(final_logits.size(0), generator=generator).to(final_logits.device)
+        total_loss = 0.0
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            loss = sum(kd_loss(head(states[batch]), final_logits[batch], temperature)
+                       for head, states in zip(heads.heads, cls_states))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item()
+        print("Epoch {}/{}: exit head loss {:.4f}".format(epoch + 1, epochs, total_loss / max(1, -(-len(order) // batch_size))))
+    return heads.eval()
+
+
+def kept_relations(proba, relation_ids, conf):
+    """
+    Relation extract_relations() would keep for each pair: its label if it is one of the relations of interest
+    and its confidence is above conf, -1 otherwise.
+
+    Input: [pairs, labels] softmax probabilities, label ids of the relations of interest, confidence threshold
+    Output: [pairs] tensor of label ids (-1 for pairs that keep nothing)
+    """
+    confidence, label = proba.max(dim=1)
+    wanted = torch.zeros(proba.size(1), dtype=torch.bool, device=proba.device)
+    wanted[relation_ids] = True
+    return torch.where(wanted[label] & (confidence > conf), label, torch.full_like(label, -1))
+
+
+def kept_change(kept, full_kept):
+    """
+    Share of the full-depth kept relations that early exit changes: pairs whose kept relation differs
+    (lost, replaced or newly kept) over the number of pairs that keep a relation at full depth. Pairs that
+    keep nothing either way are not counted, so the mostly no_relation pairs cannot dilute the error.
+
+    Input: kept relations with early exit and at full depth (from kept_relations())
+    Output: share as a float (inf if nothing is kept at full depth but something is with early exit)
+    """
+    changed = float((kept != full_kept).sum())
+    num_kept = float((full_kept >= 0).sum())
+    if num_kept == 0:
+        return 0.0 if changed == 0 else float("inf")
+    return changed / num_kept
+
+
+def exit_probabilities(bert, heads, examples):
+    """
+    Softmax probabilities of every exit head and of the full-depth classifier, from one full-depth pass.
+
+    Input: SpanBERT instance (early exit off), BertEarlyExitHeads, list of examples
+    Output: (list per exit layer of [examples, labels] probabilities, [examples, labels] final probabilities)
+    """
+    cls_states, final_logits = full_depth_pass(bert, heads, examples)
+    with torch.inference_mode():
+        head_proba = [torch.softmax(head(states).float(), dim=1) for head, states in zip(heads.heads, cls_states)]
+    return head_proba, torch.softmax(final_logits, dim=1)
+
+
+def simulate_early_exit(final_proba, head_proba, exit_layers, num_layers, relation_ids, conf, threshold,
+                        screen_threshold=0.0):
+    """
+    Replay early exit as BertForSequenceClassification.early_exit_forward() runs it: at each exit layer a
+    pair leaves when its head is at least `threshold` confident, or when the head gives the relations of
+    interest less than `screen_threshold` in total (those relations are then ruled out for the pair).
+
+    Input: final and per exit layer probabilities (from exit_probabilities()), 0-based exit layers, number of
+           encoder layers, label ids of the relations of interest, confidence threshold of the kept relations, exit and screen thresholds
+    Output: (kept relation of every pair, see kept_relations(); [examples] number of layers run)
+    """
+    proba = final_proba.clone()
+    layers = torch.full((final_proba.size(0),), float(num_layers), device=final_proba.device)
+    exited = torch.zeros(final_proba.size(0), dtype=torch.bool, device=final_proba.device)
+    screened = torch.zeros_like(exited)
+    for index, exit_proba in zip(exit_layers, head_proba):
+        unreachable = ~exited & (exit_proba[:, relation_ids].sum(dim=1) < screen_threshold)
+        leaving = ~exited & ((exit_proba.max(dim=1)[0] >= threshold) | unreachable)
+        proba[leaving] = exit_proba[leaving]
+        layers[leaving] = index + 1
+        screened |= unreachable
+        exited |= leaving
+    kept = kept_relations(proba, relation_ids, conf)
+    kept[screened] = -1
+    return kept, layers
+
+
+def calibrate_exit_threshold(bert, heads, examples, relation_ids, tolerance=0.01, conf=0.7):
+    """
+    Pick the lowest exit threshold whose early exit predictions change at most a `tolerance` share of the
+    relations extraction keeps at full depth (relations of interest with confidence above conf, see
+    kept_change()). Every candidate threshold is simulated from one full-depth pass.
+
+    Input: SpanBERT instance, BertEarlyExitHeads, calibration examples, label ids of the relations of interest,
+           tolerated share of changed kept relations, confidence threshold of the kept relations
+    Output: (threshold, share of changed kept relations, average number of layers run per pair)
+    """
+    head_proba, final_proba = exit_probabilities(bert, heads, examples)
+    full_kept = kept_relations(final_proba, relation_ids, conf)
+    num_kept = int((full_kept >= 0).sum())
+    if 0 < tolerance and num_kept * tolerance < 1:
+        print("Warning: only {} calibration pairs keep a relation, too few to resolve a {:.1%} tolerance".format(
+            num_kept, tolerance))
+
+    num_layers = bert.classifier.config.num_hidden_layers
+    for threshold in [round(0.50 + 0.01 * i, 2) for i in range(51)]:
+        kept, layers = simulate_early_exit(final_proba, head_proba, heads.exit_layers, num_layers, relation_ids,
+                                           conf, threshold)
+        changed = kept_change(kept, full_kept)
+        if changed <= tolerance:
+            return threshold, changed, float(layers.mean())
+    return 1.01, 0.0, float(num_layers)
+
+
+def calibrate_screen_threshold(bert, heads, examples, relation_ids, tolerance=0.01, conf=0.7):
+    """
+    Pick the highest screen threshold for which early exit with the heads' (already calibrated) exit threshold
+    and the screen together change at most a `tolerance` share of the relations kept at full depth, so the
+    two approximations never add up past the tolerance. The threshold only holds for this set of relations
+    of interest, so it is saved with them (see BertEarlyExitHeads.screen_labels).
+
+    Input: SpanBERT instance, BertEarlyExitHeads with their exit threshold, calibration examples, label ids of
+           the relations of interest, tolerated share of changed kept relations, confidence threshold of the kept relations
+    Output: (screen threshold, combined share of changed kept relations, average number of layers run per pair)
+    """
+    head_proba, final_proba = exit_probabilities(bert, heads, examples)
+    full_kept = kept_relations(final_proba, relation_ids, conf)
+
+    num_layers = bert.classifier.config.num_hidden_layers
+    kept, layers = simulate_early_exit(final_proba, head_proba, heads.exit_layers, num_layers, relation_ids,
+                                       conf, heads.threshold)
+    best = (0.0, kept_change(kept, full_kept), float(layers.mean()))
+    for screen_threshold in [round(0.01 * i, 2) for i in range(1, 51)]:
+        kept, layers = simulate_early_exit(final_proba, head_proba, heads.exit_layers, num_layers, relation_ids,
+                                           conf, heads.threshold, screen_threshold)
+        changed = kept_change(kept, full_kept)
+        if changed > tolerance:
+            break
+        best = (screen_threshold, changed, float(layers.mean()))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and compare smaller SpanBERT relation classifiers")
+    parser.add_argument("command", choices=["distill", "tradeoff", "early-exit"])
+    parser.add_argument("--teacher", default="./pretrained_spanbert", help="checkpoint folder of the full model")
+    parser.add_argument("--layers", type=int, nargs="*", default=[], help="student layer counts")
+    parser.add_argument("--examples", help="JSON / JSON lines file of candidate pairs")
+    parser.add_argument("--students", nargs="*", default=[], help="distilled student folders to compare")
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--learning-rate", type=float, default=5e-5)
+    parser.add_argument("--out", help="output folder of the student (distill with one --layers value)")
+    parser.add_argument("--exit-layers", type=int, nargs="*", help="0-based layers followed by an exit head")
+    parser.add_argument("--calibration", help="JSON / JSON lines file of pairs used to calibrate the exit threshold "
+                                              "(held out from --examples, with enough kept relations to resolve --tolerance)")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="share of the kept relations that may change")
+    parser.add_argument("--relations", nargs="*", help="relations of interest of the runs using the heads (defaults "
+                                                       "to every relation except no_relation, without a screen)")
+    parser.add_argument("--conf", type=float, default=0.7, help="confidence threshold of the runs using the heads")
+    args = parser.parse_args()
+
+    teacher = SpanBERT(args.teacher)
+    examples = load_examples(args.examples) if args.examples else None
+
+    if args.command == "distill":
+        if not args.layers or examples is None:
+            parser.error("distill needs --layers and --examples")
+        if args.out and len(args.layers) > 1:
+            parser.error("--out needs a single --layers value")
+        for num_layers in args.layers:
+            student = distill(teacher, make_student(teacher, num_layers), examples, args.epochs, args.learning_rate)
+            save_student(student, args.out or "{}_L{}".format(args.teacher.rstrip("/"), num_layers))
+        return
+
+    if args.command == "early-exit":
+        if examples is None or not args.calibration:
+            parser.error("early-exit needs --examples and --calibration")
+        relations = args.relations or [label for label in teacher.label2id if label != "no_relation"]
+        unknown = [relation for relation in relations if relation not in teacher.label2id]
+        if unknown:
+            parser.error("unknown relations: {}".format(", ".join(unknown)))
+        relation_ids = [teacher.label2id[relation] for relation in relations]
+        config = teacher.classifier.config
+        exit_layers = args.exit_layers or evenly_spaced_layers(config.num_hidden_layers, 4)[:-1]
+        heads = BertEarlyExitHeads(config, teacher.num_labels, exit_layers).init_from(teacher.classifier).float()
+        heads = train_exit_heads(teacher, heads, examples)
+        calibration = load_examples(args.calibration)
+        heads.threshold, changed, layers = calibrate_exit_threshold(teacher, heads, calibration, relation_ids,
+                                                                    args.tolerance, args.conf)
+        print("Exit threshold {:.2f}: {:.1%} of kept relations change, {:.1f} of {} layers per pair on average".format(
+            heads.threshold, changed, layers, config.num_hidden_layers))
+        # the screen keeps the relations of interest reachable, so it is only calibrated for an explicit set
+        if args.relations:
+            heads.screen_threshold, changed, layers = calibrate_screen_threshold(teacher, heads, calibration, relation_ids,
+                                                                                 args.tolerance, args.conf)
+            heads.screen_labels = relation_ids
+            print("Screen threshold {:.2f} for {}: {:.1%} of kept relations change with exit and screen together, "
+                  "{:.1f} layers per pair on average".format(heads.screen_threshold, ", ".join(relations), changed, layers))
+        heads.save(os.path.join(args.teacher, EARLY_EXIT_HEADS))
+        return
+
+    # Layer-dropped tiers (no training) and distilled students
+    tiers = [("dropped to {} layers".format(n), student_spanbert(teacher, make_student(teacher, n).eval()))
+             for n in args.layers]
+    tiers += [(os.path.basename(path.rstrip("/")), SpanBERT(path)) for path in args.students]
+    tradeoff_report(teacher, tiers, examples)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+This file contains alternative runtimes for the SpanBERT relation classifier, used instead of running eager
+PyTorch module by module. The classifier can be exported to ONNX once and executed with ONNX Runtime, whose
+graph optimizer fuses attention, GELU and LayerNorm into single kernels, or traced and frozen with
+TorchScript, which removes the Python overhead of the 24 layers. Both artifacts are cached on disk.
+"""
+
+# Environment Set Up
+import inspect
+import os
+import time
+
+import numpy as np
+import torch
+
+from spanbert import EVALUATION_EXAMPLES, convert_examples_to_features, make_batches, special_tokens
+
+# ONNX Runtime is optional; without it SpanBERT keeps running in PyTorch
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+INPUT_NAMES = ["input_ids", "segment_ids", "input_mask"]
+OUTPUT_NAMES = ["logits"]
+
+# Largest difference between torch and runtime logits accepted by the parity check
+parity_tolerance = 1e-3
+
+
+def export_onnx(classifier, path, opset_version=14):
+    """
+    Export a BertForSequenceClassification to ONNX. Batch size and sequence length are dynamic axes, so the
+    dynamically padded batches of SpanBERT.predict() can be run without re-exporting.
+
+    Input: classifier (fp32, not quantized), path of the .onnx file, ONNX opset
+    Output: N/A
+    """
+    classifier = classifier.float().cpu().eval()
+    dummy = torch.ones(2, 16, dtype=torch.long)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in INPUT_NAMES}
+    dynamic_axes["logits"] = {0: "batch"}
+
+    # newer torch versions default to the dynamo exporter; the TorchScript based one handles dynamic_axes here
+    options = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        options["dynamo"] = False
+
+    # write to a temporary file first so an interrupted export never leaves a broken model behind
+    tmp_path = path + ".tmp"
+    with torch.no_grad():
+        torch.onnx.export(classifier, (dummy, torch.zeros_like(dummy), dummy), tmp_path,
+                          input_names=INPUT_NAMES, output_names=OUTPUT_NAMES, dynamic_axes=dynamic_axes,
+                          opset_version=opset_version, do_constant_folding=True, **options)
+    os.replace(tmp_path, path)
+
+
+class OnnxClassifier:
+    """
+    ONNX Runtime session with the call signature of BertForSequenceClassification, so spanbert.predict()
+    runs it exactly like the torch model (logits come back as a torch tensor).
+    """
+
+    def __init__(self, path, num_threads=None):
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_ids, token_type_ids=None, attention_mask=None, labels=None):
+        inputs = {"input_ids": input_ids.cpu().numpy(),
+                  "segment_ids": token_type_ids.cpu().numpy(),
+                  "input_mask": attention_mask.cpu().numpy()}
+        logits, = self.session.run(OUTPUT_NAMES, inputs)
+        return torch.from_numpy(logits)
+
+
+def check_parity(bert, runner, examples=None):
+    """
+    Compare the logits of a runtime backend with the torch classifier on the same dynamically padded batches.
+
+    Input: SpanBERT instance, backend to check, examples (defaults to EVALUATION_EXAMPLES)
+    Output: (largest absolute logit difference, whether every predicted label matches)
+    """
+    examples = EVALUATION_EXAMPLES if examples is None else examples
+    features = convert_examples_to_features(examples, bert.max_seq_length, bert.tokenizer, special_tokens,
+                                            pad_to_max_length=False, mode=bert.encoding_mode)
+    batches, _ = make_batches(features, bert.batch_size, bert.max_seq_length, bert.pad_multiple)
+
+    max_diff = 0.0
+    labels_match = True
+    bert.classifier.eval()
+    with torch.inference_mode():
+        for input_ids, input_mask, segment_ids in batches:
+            input_ids = input_ids.to(bert.device)
+            input_mask = input_mask.to(bert.device)
+            segment_ids = segment_ids.to(bert.device)
+            expected = bert.classifier(input_ids, segment_ids, input_mask).float().cpu().numpy()
+            # runners take inputs on the model's device (OnnxClassifier copies them to the host itself)
+            actual = runner(input_ids, segment_ids, input_mask).float().cpu().numpy()
+            max_diff = max(max_diff, float(np.abs(expected - actual).max()))
+            labels_match = labels_match and bool((expected.argmax(1) == actual.argmax(1)).all())
+    return max_diff, labels_match
+
+
+def encoder_mode(classifier):
+    """
+    Name of the encoder graph a classifier runs: packed or padded layers, fused or separate Q/K/V projections,
+    and scaled_dot_product_attention or the explicit softmax. Traced and exported artifacts bake one graph
+    in, so it is part of their cache key.
+
+    Input: BertForSequenceClassification
+    Output: string such as "packed-fused-sdpa"
+    """
+    packed = getattr(classifier.bert, "packed_inference", False)
+    fused = any(getattr(module, "qkv", None) is not None for module in classifier.modules())
+    sdpa = hasattr(torch.nn.functional, "scaled_dot_product_attention")
+    return "{}-{}-{}".format("packed" if packed else "padded", "fused" if fused else "unfused",
+                             "sdpa" if sdpa else "softmax")
+
+
+def is_stale(artifact_path, pretrained_dir):
+    """
+    Check whether a cached artifact is missing or older than the checkpoint it was built from.
+
+    Input: path of the artifact, folder of the pre-trained checkpoint
+    Output: True if the artifact has to be (re)built
+    """
+    if not os.path.exists(artifact_path):
+        return True
+    checkpoint = os.path.join(pretrained_dir, "pytorch_model.bin")
+    return os.path.exists(checkpoint) and os.path.getmtime(checkpoint) > os.path.getmtime(artifact_path)
+
+
+def load_onnx_backend(bert, pretrained_dir, onnx_path=None):
+    """
+    Switch a SpanBERT instance to ONNX Runtime. The model is exported on first use (and again whenever the
+    checkpoint is newer than the export), then checked against the torch classifier; on a parity failure,
+    a missing onnxruntime or a non fp32 CPU model, SpanBERT keeps running in PyTorch.
+
+    Input: SpanBERT instance, folder of the pre-trained checkpoint, path of the .onnx file (defaults to
+           spanbert-<layers>L-<encoder mode>.onnx in the checkpoint folder)
+    Output: True if SpanBERT now runs on ONNX Runtime, False otherwise
+    """
+    if onnxruntime is None:
+        print("onnxruntime is not installed; running SpanBERT in PyTorch")
+        return False
+    if bert.fp16 or bert.quantized:
+        print("The ONNX backend runs the fp32 CPU model; running SpanBERT in PyTorch")
+        return False
+    if bert.classifier.early_exit is not None:
+        print("Early exit depends on the data and cannot be exported; running SpanBERT in PyTorch")
+        return False
+
+    onnx_path = onnx_path or os.path.join(pretrained_dir, "spanbert-{}L-{}.onnx".format(
+        bert.classifier.config.num_hidden_layers, encoder_mode(bert.classifier)))
+    if is_stale(onnx_path, pretrained_dir):
+        print("Exporting spanBERT to {}".format(onnx_path))
+        export_onnx(bert.classifier, onnx_path)
+
+    runner = OnnxClassifier(onnx_path)
+    max_diff, labels_match = check_parity(bert, runner)
+    if max_diff > parity_tolerance or not labels_match:
+        print("ONNX Runtime does not match PyTorch (max logit difference {:.2e}); running SpanBERT in PyTorch".format(max_diff))
+        return False
+
+    print("Running spanBERT on ONNX Runtime (max logit difference {:.2e})".format(max_diff))
+    bert.runner = runner
+    return True
+
+
+def trace_classifier(classifier, device):
+    """
+    Trace the classifier with TorchScript and freeze it: weights become constants and the graph is
+    optimized for inference. Sequence positions are computed from the input size, so one trace serves every
+    batch shape.
+
+    Input: classifier in eval mode, device it runs on
+    Output: frozen torch.jit.ScriptModule with the classifier's (input_ids, token_type_ids, attention_mask) signature
+    """
+    classifier.eval()
+    dummy = torch.ones(2, 16, dtype=torch.long, device=device)
+    with torch.no_grad():
+        traced = torch.jit.trace(classifier, (dummy, torch.zeros_like(dummy), dummy), check_trace=False)
+    return torch.jit.freeze(traced)
+
+
+def warm_up(bert, runs=2):
+    """
+    Run the evaluation examples through SpanBERT a few times. The TorchScript profiling executor optimizes
+    the graph during the first calls, so this moves that cost to load time instead of the first page.
+
+    Input: SpanBERT instance, number of passes
+    Output: N/A
+    """
+    for _ in range(runs):
+        bert.predict(EVALUATION_EXAMPLES)
+
+
+def load_torchscript_backend(bert, pretrained_dir, script_path=None):
+    """
+    Switch a SpanBERT instance to a traced and frozen TorchScript module. The module is compiled once and
+    cached on disk (per layer count, encoder mode, torch version, device and precision, and rebuilt when the checkpoint
+    is newer), so later runs only load it. It is checked against the eager classifier, then warmed up.
+
+    Input: SpanBERT instance, folder of the pre-trained checkpoint, path of the cached module (defaults to
+           spanbert-<layers>L-<encoder mode>-<torch version>-<device>-<precision>.torchscript.pt in the checkpoint folder)
+    Output: True if SpanBERT now runs the TorchScript module, False otherwise
+    """
+    if bert.classifier.early_exit is not None:
+        print("Early exit depends on the data and cannot be traced; running SpanBERT in eager mode")
+        return False
+
+    precision = "fp16" if bert.fp16 else "int8" if bert.quantized else "fp32"
+    script_path = script_path or os.path.join(pretrained_dir, "spanbert-{}L-{}-{}-{}-{}.torchscript.pt".format(
+        bert.classifier.config.num_hidden_layers, encoder_mode(bert.classifier), torch.__version__.replace("+", "_"),
+        bert.device.type, precision))
+
+    if is_stale(script_path, pretrained_dir):
+        print("Compiling spanBERT with TorchScript to {}".format(script_path))
+        runner = trace_classifier(bert.classifier, bert.device)
+        tmp_path = script_path + ".tmp"
+        torch.jit.save(runner, tmp_path)
+        os.replace(tmp_path, script_path)
+    else:
+        runner = torch.jit.load(script_path, map_location=bert.device)
+
+    max_diff, labels_match = check_parity(bert, runner)
+    if max_diff > parity_tolerance or not labels_match:
+        print("TorchScript does not match PyTorch (max logit difference {:.2e}); running SpanBERT in eager mode".format(max_diff))
+        return False
+
+    bert.runner = runner
+    start = time.time()
+    warm_up(bert)
+    print("Running spanBERT with TorchScript (max logit difference {:.2e}, warm-up {:.1f}s)".format(max_diff, time.time() - start))
+    return True
@@ -0,0 +1,353 @@
+"""
+This file contains the on-disk cache used by web_scraping.py so that rerunning a query does not
+re-download every page from scratch.
+"""
+
+# Environment Set Up
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of raw HTTP response bodies.
+
+    Bodies are stored once per unique content under bodies/<sha256>, so mirrors of the same page share
+    a file. index.json maps each URL to its body hash and the headers needed to revalidate it
+    (ETag, Last-Modified). When the cache grows past max_bytes the least recently used URLs are evicted.
+    """
+
+    def __init__(self, cache_dir, max_bytes=200 * 1024 * 1024, ttl=24 * 60 * 60, offline=False):
+        self.cache_dir = cache_dir
+        self.body_dir = os.path.join(cache_dir, "bodies")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.offline = offline
+        self._lock = threading.Lock()
+        # access times changed since index.json was last written
+        self._dirty = False
+
+        os.makedirs(self.body_dir, exist_ok=True)
+        self.index = self._load_index()
+
+        # access times of pages served from the cache are written once at exit instead of on every hit
+        atexit.register(self.flush)
+
+    def _load_index(self):
+        """
+        Read index.json from disk. A missing or corrupt index starts an empty cache.
+
+        Input: N/A
+        Output: dictionary of url -> cache entry
+        """
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        """
+        Write index.json atomically so a crash mid-write never leaves a half written index.
+
+        Input: N/A
+        Output: N/A
+        """
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+        self._dirty = False
+
+    def flush(self):
+        """
+        Write access times recorded since the last save, so LRU eviction in later runs sees which pages
+        are still in use.
+
+        Input: N/A
+        Output: N/A
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                self._save_index()
+            except OSError:
+                pass
+
+    def _body_path(self, digest):
+        return os.path.join(self.body_dir, digest)
+
+    def lookup(self, url):
+        """
+        Find the cache entry for a URL.
+
+        Input: URL
+        Output: cache entry dictionary, or None on a miss (or if the body file went missing)
+        """
+        with self._lock:
+            entry = self.index.get(url)
+            if entry is None:
+                return None
+            if not os.path.exists(self._body_path(entry["body"])):
+                del self.index[url]
+                return None
+            return dict(entry)
+
+    def is_fresh(self, entry):
+        """
+        Check whether an entry is young enough to be served without asking the server.
+
+        Input: cache entry
+        Output: True or False
+        """
+        return (time.time() - entry["stored"]) < self.ttl
+
+    def conditional_headers(self, entry):
+        """
+        Build the revalidation headers for a stale entry.
+
+        Input: cache entry
+        Output: dictionary of If-None-Match / If-Modified-Since headers (may be empty)
+        """
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def read_text(self, entry):
+        """
+        Read a cached body back from disk and mark the entry as recently used.
+
+        Input: cache entry
+        Output: decoded HTML text, or None if the body could not be read
+        """
+        try:
+            with open(self._body_path(entry["body"]), "rb") as f:
+                body = f.read()
+        except OSError:
+            return None
+
+        self.touch(entry["url"])
+        return body.decode(entry.get("encoding") or "utf-8", errors="replace")
+
+    def touch(self, url, revalidated=False):
+        """
+        Update the access time of an entry (and its stored time after a 304 revalidation, which is saved
+        right away; plain access times are saved by flush()).
+
+        Input: URL, whether the server just confirmed the entry is still valid
+        Output: N/A
+        """
+        with self._lock:
+            entry = self.index.get(url)
+            if entry is None:
+                return
+            now = time.time()
+            entry["accessed"] = now
+            self._dirty = True
+            if revalidated:
+                entry["stored"] = now
+                self._save_index()
+
+    def store(self, url, headers, body, encoding):
+        """
+        Save a response body and its revalidation headers, then evict old entries if over budget.
+
+        Input: URL, response headers, raw body bytes, text encoding of the body
+        Output: N/A
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        path = self._body_path(digest)
+
+        with self._lock:
+            # Identical content is only written once
+            if not os.path.exists(path):
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(body)
+                os.replace(tmp_path, path)
+
+            # A changed page replaces its entry; drop the old body unless another url still points at it
+            previous = self.index.get(url)
+            if previous is not None and previous["body"] != digest:
+                del self.index[url]
+                if not any(entry["body"] == previous["body"] for entry in self.index.values()):
+                    try:
+                        os.remove(self._body_path(previous["body"]))
+                    except OSError:
+                        pass
+
+            now = time.time()
+            self.index[url] = {
+                "url": url,
+                "body": digest,
+                "size": len(body),
+                "encoding": encoding,
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "stored": now,
+                "accessed": now,
+            }
+            self._evict()
+            self._save_index()
+
+    def total_bytes(self):
+        """
+        Total size of the unique bodies referenced by the index.
+
+        Input: N/A
+        Output: number of bytes
+        """
+        sizes = {entry["body"]: entry["size"] for entry in self.index.values()}
+        return sum(sizes.values())
+
+    def _evict(self):
+        """
+        Drop least recently used entries until the cache fits in max_bytes. Body files are only
+        removed once no remaining URL points at them. Caller must hold the lock.
+
+        Input: N/A
+        Output: N/A
+        """
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+
+        # Count how many urls point at each body
+        refs = Counter(entry["body"] for entry in self.index.values())
+
+        for entry in sorted(self.index.values(), key=lambda e: e["accessed"]):
+            if total <= self.max_bytes:
+                break
+            del self.index[entry["url"]]
+            refs[entry["body"]] -= 1
+
+            # Only delete the body when it is not shared with another url
+            if refs[entry["body"]] == 0:
+                total -= entry["size"]
+                try:
+                    os.remove(self._body_path(entry["body"]))
+                except OSError:
+                    pass
+
+
+class SearchCache:
+    """
+    Persistent query -> URL list cache for the Custom Search JSON API.
+
+    Rerunning a job, or two jobs that generate the same query from get_next_query(), read the URL list
+    from disk instead of spending API quota. Entries expire after ttl seconds and the least recently
+    used queries are dropped once there are more than max_entries.
+    """
+
+    def __init__(self, cache_path, max_entries=1000, ttl=7 * 24 * 60 * 60):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # access times changed since the cache file was last written
+        self._dirty = False
+
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+        # access times of cache hits are written once at exit
+        atexit.register(self.flush)
+
+    @staticmethod
+    def make_key(query, cx, num):
+        """
+        Key a search by everything that changes its results (the API key does not).
+
+        Input: query string, search engine id, number of results
+        Output: hex string key
+        """
+        return hashlib.sha256(json.dumps([query, cx, num]).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Look up the URL list for a search, counting hits and misses.
+
+        Input: key from make_key()
+        Output: list of URLs, or None on a miss or expired entry
+        """
+        entry = self.entries.get(key)
+        if entry is None or (time.time() - entry["stored"]) >= self.ttl:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entry["accessed"] = time.time()
+        self._dirty = True
+        return list(entry["urls"])
+
+    def put(self, key, urls):
+        """
+        Save the URL list for a search and write the cache back to disk.
+
+        Input: key from make_key(), list of URLs
+        Output: N/A
+        """
+        now = time.time()
+        self.entries[key] = {"urls": list(urls), "stored": now, "accessed": now}
+
+        # Drop expired entries, then the least recently used ones if still over the limit
+        self.entries = {k: e for k, e in self.entries.items() if (now - e["stored"]) < self.ttl}
+        if len(self.entries) > self.max_entries:
+            keep = sorted(self.entries, key=lambda k: self.entries[k]["accessed"], reverse=True)[:self.max_entries]
+            self.entries = {k: self.entries[k] for k in keep}
+
+        self._save()
+
+    def _save(self):
+        """
+        Write the cache file atomically.
+
+        Input: N/A
+        Output: N/A
+        """
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.cache_path)
+        self._dirty = False
+
+    def flush(self):
+        """
+        Write access times recorded since the last save, so LRU eviction in later runs sees which
+        queries are still in use.
+
+        Input: N/A
+        Output: N/A
+        """
+        if not self._dirty:
+            return
+        try:
+            self._save()
+        except OSError:
+            pass
+
+    def stats(self):
+        """
+        Hit/miss counters for this run.
+
+        Input: N/A
+        Output: dictionary with hits, misses and hit rate
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
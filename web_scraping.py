@@ -5,53 +5,632 @@ This file is for web scraping the data from gathered websites and returnining pl
 # Environment Set Up
 import requests
 import re
+import asyncio
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 from bs4 import BeautifulSoup, Comment
+from requests.adapters import HTTPAdapter
+from web_cache import ResponseCache
 
-def fetch_website(url):
+# Faster HTML parsers are optional; extract_plain_text() falls back to BeautifulSoup without them
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    HTMLParser = None
+
+# Brotli decoding is only available when the brotli package is installed
+try:
+    import brotli
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+# Shared HTTP session used by search() and fetch_website(), created on first use
+_session = None
+_session_lock = threading.Lock()
+
+# On-disk response cache, off until enable_response_cache() is called
+response_cache = None
+
+# Timeouts in seconds for opening a connection and for waiting on the server between bytes
+connect_timeout = 5
+read_timeout = 15
+
+# Statuses worth retrying later (throttled, server errors)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Largest page body we download; anything past it is cut off (HTML only)
+max_page_bytes = 2 * 1024 * 1024
+HTML_CONTENT_TYPES = {"text/html", "application/xhtml+xml"}
+
+# Number of characters of plain text kept per page
+max_text_chars = 10000
+WHITESPACE = re.compile(r'\s+')
+
+# Tags whose text never counts as page content
+SKIPPED_TAGS = ["script", "style", "noscript", "template", "nav"]
+
+# Main-content extraction: keep only the article body instead of the whole page (menus, banners, footers)
+extract_main_content = False
+BOILERPLATE_TAGS = ["header", "footer", "aside", "form", "iframe", "button", "select", "svg"]
+UNLIKELY_CANDIDATES = re.compile(r'banner|breadcrumb|comment|consent|cookie|footer|header|menu|modal|nav|newsletter|popup|promo|related|share|sidebar|social|sponsor|subscribe|widget|advert', re.I)
+LIKELY_CANDIDATES = re.compile(r'article|body|content|entry|main|post|story|text', re.I)
+BLOCK_TAGS = {"p", "div", "section", "article", "table", "ul", "ol", "pre", "blockquote", "h1", "h2", "h3", "h4", "h5", "h6"}
+min_main_content_chars = 250
+
+# HTML to text backend used by extract_plain_text(): "auto", "selectolax", "lxml" or "bs4"
+text_backend = "auto"
+
+# Connection pool settings (number of hosts kept in the pool, open connections kept per host)
+pool_connections = 20
+pool_maxsize = 10
+
+
+def configure_session(connections=None, maxsize=None):
     """
-    Fetch HTML from URLs found via search()
+    Change the connection pool sizes of the shared session. The current session is closed and
+    a new one with the new sizes is built on the next request.
+
+    Input: number of host pools to keep, number of connections to keep per host
+    Output: N/A
+    """
+    global _session, pool_connections, pool_maxsize
+
+    if connections is not None:
+        pool_connections = connections
+    if maxsize is not None:
+        pool_maxsize = maxsize
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def get_session():
+    """
+    Return the shared keep-alive session, building it on first use.
+
+    Connections are pooled per host and reused across calls and ISE iterations, so repeated requests
+    to googleapis.com or to the same news site skip the TCP/TLS handshake.
+
+    Input: N/A
+    Output: requests.Session
+    """
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({
+                "Accept-Encoding": ACCEPT_ENCODING,
+                "Connection": "keep-alive",
+            })
+            _session = session
+
+    return _session
+
+
+def enable_response_cache(cache_dir, max_bytes=200 * 1024 * 1024, ttl=24 * 60 * 60, offline=False):
+    """
+    Turn on the on-disk response cache (web_cache.py) used by fetch_website().
+
+    Input: cache directory, size budget in bytes (LRU eviction past it), seconds a page is served
+           without revalidation, offline flag (only serve cached pages younger than ttl, never hit the network)
+    Output: the ResponseCache in use
+    """
+    global response_cache
 
-    Input: URL (gathered from the search function)
+    response_cache = ResponseCache(cache_dir, max_bytes=max_bytes, ttl=ttl, offline=offline)
+    return response_cache
+
+
+class FetchError(Exception):
+    """
+    Raised by download_page() when a page cannot be fetched. retryable tells a scheduler whether trying
+    again later could help (timeouts, connection resets, 429/5xx), retry_after is the server's Retry-After in seconds.
+    """
+
+    def __init__(self, message, retryable=False, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header given in seconds (the HTTP-date form is ignored).
+
+    Input: header value or None
+    Output: seconds as a float, or None
+    """
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def download_page(url, timeout=None, deadline=None):
+    """
+    Download the HTML of a page, raising FetchError when it cannot be fetched.
+
+    If the response cache is enabled, fresh cached pages are read from disk, stale ones are revalidated
+    with ETag/Last-Modified and only re-downloaded when the server says they changed.
+
+    Input: URL, (connect, read) timeout in seconds (defaults to connect_timeout/read_timeout),
+           time.monotonic() deadline after which the body download is abandoned
     Output: HTML
     """
-    print("        Fetching text from url ...")
+    if timeout is None:
+        timeout = (connect_timeout, read_timeout)
 
-    # Try to fetch URL
-    try: 
-        response = requests.get(url)
-        # If response code is not 200, inform user and move on
+    # Check the disk cache before going to the network
+    cached = response_cache.lookup(url) if response_cache is not None else None
+    headers = {}
+    if cached is not None and response_cache.is_fresh(cached):
+        html = response_cache.read_text(cached)
+        if html is not None:
+            return html
+    if response_cache is not None and response_cache.offline:
+        # Offline mode never touches the network
+        raise FetchError("Page not in cache (offline mode).")
+    if cached is not None:
+        headers = response_cache.conditional_headers(cached)
+
+    try:
+        # Stream the body so we can look at the headers before downloading anything
+        response = get_session().get(url, headers=headers, stream=True, timeout=timeout)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise FetchError(f"Connection failed: {e}", retryable=True)
+    except requests.RequestException as e:
+        raise FetchError(f"Request failed: {e}")
+
+    try:
+        # Page unchanged since we cached it, serve it from disk
+        if response.status_code == 304 and cached is not None:
+            response_cache.touch(url, revalidated=True)
+            html = response_cache.read_text(cached)
+            if html is None:
+                raise FetchError("Cached page could not be read.", retryable=True)
+            return html
+
+        # If response code is not 200 there is no page to return; throttling and server errors may pass
         if response.status_code != 200:
-            raise Exception(f"Unable to fetch URL. Continuing.")
-        html = response.text
+            raise FetchError(f"HTTP status {response.status_code}.",
+                             retryable=response.status_code in RETRY_STATUSES,
+                             retry_after=parse_retry_after(response.headers.get("Retry-After")))
 
-        return html
+        # Skip non-HTML documents (PDFs, images, ...) and pages we already know are too big
+        content_type = response.headers.get("Content-Type", "text/html").split(";")[0].strip().lower()
+        if content_type not in HTML_CONTENT_TYPES:
+            raise FetchError(f"Skipping non-HTML content ({content_type}).")
+        content_length = response.headers.get("Content-Length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_page_bytes:
+            raise FetchError(f"Skipping page larger than {max_page_bytes} bytes.")
+
+        # Read the body in chunks and stop at the byte ceiling
+        try:
+            body = read_capped_body(response, max_page_bytes, deadline)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise FetchError(f"Connection failed while reading: {e}", retryable=True)
+        except requests.RequestException as e:
+            raise FetchError(f"Reading the page failed: {e}")
+    finally:
+        response.close()
+
+    # An unknown charset in the headers (e.g. a typo) falls back to utf-8 instead of failing the page
+    encoding = response.encoding or "utf-8"
+    try:
+        html = body.decode(encoding, errors="replace")
+    except LookupError:
+        encoding = "utf-8"
+        html = body.decode(encoding, errors="replace")
+
+    # A cache write failure (disk full, permissions) must not cost us a page we already downloaded
+    if response_cache is not None:
+        try:
+            response_cache.store(url, response.headers, body, encoding)
+        except OSError as e:
+            print(f"        Could not cache {url}: {e}")
+
+    return html
+
+
+def fetch_website(url, verbose=True):
+    """
+    Fetch HTML from URLs found via search()
+
+    Input: URL (gathered from the search function), verbose flag to print progress to the terminal
+    Output: HTML, or None if the page could not be fetched
+    """
+    if verbose:
+        print("        Fetching text from url ...")
+
+    # Try to fetch URL
+    try: 
+        return download_page(url)
 
     # Catch any other exception as unable to fetch and move on
     except Exception as e:
-        print(f"Unable to fetch URL. Continuing.")
+        if verbose:
+            print(f"Unable to fetch URL. Continuing.")
         return None
-        
-def extract_plain_text(html):
+
+
+def read_capped_body(response, max_bytes, deadline=None):
     """
-    Extract plain text from HTML using BeautifulSoup
+    Read a streamed response body, stopping once max_bytes have been read.
 
-    Input: HTML (fetched from fetch_website)
-    Output: Plain text
+    Input: a requests response opened with stream=True, byte ceiling, optional time.monotonic() deadline
+    Output: body bytes (at most max_bytes long)
+    """
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= max_bytes:
+            break
+        # a server trickling bytes would never trip the read timeout, so also check the deadline
+        if deadline is not None and time.monotonic() > deadline:
+            raise FetchError("Deadline passed while reading the page.")
+
+    return b"".join(chunks)[:max_bytes]
+
+
+class AsyncFetcher:
+    """
+    Fetch all URLs of an ISE iteration concurrently instead of one after another.
+
+    Downloads run on a thread pool driven by an asyncio event loop. A global limit caps how many
+    downloads run at once and a per-host limit keeps us from hammering a single site. Pages are
+    handed back as soon as they arrive, so extraction can start on the first page while the rest download.
+    """
+
+    def __init__(self, max_concurrency=10, per_host_limit=2, fetch=None):
+        self.max_concurrency = max_concurrency
+        self.per_host_limit = per_host_limit
+        # function taking a URL and returning its HTML or None (e.g. FetchScheduler.fetch)
+        self.fetch = fetch if fetch is not None else (lambda url: fetch_website(url, False))
+
+    async def _fetch_one(self, index, url, global_limit, host_limits, executor):
+        """
+        Fetch a single URL once both its host slot and a global slot are free.
+
+        Input: position of the URL in the iteration, URL, global and per-host semaphores, thread pool
+        Output: (index, url, html) where html is None if the page could not be fetched
+        """
+        # Wait on the host first so a slow host does not hold a global slot while queued
+        async with host_limits[urlparse(url).netloc]:
+            async with global_limit:
+                loop = asyncio.get_running_loop()
+                html = await loop.run_in_executor(executor, self.fetch, url)
+
+        return index, url, html
+
+    async def fetch_all(self, urls):
+        """
+        Fetch every URL concurrently, yielding pages in the order they finish downloading.
+
+        Input: list of URLs for the current iteration
+        Output: async generator of (index, url, html) tuples
+        """
+        global_limit = asyncio.Semaphore(self.max_concurrency)
+        host_limits = defaultdict(lambda: asyncio.Semaphore(self.per_host_limit))
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            tasks = [asyncio.ensure_future(self._fetch_one(i, url, global_limit, host_limits, executor))
+                     for i, url in enumerate(urls)]
+            for next_page in asyncio.as_completed(tasks):
+                yield await next_page
+
+    def iter_fetch(self, urls):
+        """
+        Synchronous wrapper around fetch_all() for the main ISE loop.
+
+        The event loop runs in a background thread so downloads keep going while the caller
+        is busy annotating the page it was just given.
+
+        Input: list of URLs for the current iteration
+        Output: generator of (index, url, html) tuples in completion order
+        """
+        pages = queue.Queue()
+        done = object()
+
+        async def drain():
+            try:
+                async for page in self.fetch_all(urls):
+                    pages.put(page)
+            finally:
+                pages.put(done)
+
+        worker = threading.Thread(target=asyncio.run, args=(drain(),), daemon=True)
+        worker.start()
+
+        # Hand each page to the caller as soon as it lands in the queue
+        while True:
+            page = pages.get()
+            if page is done:
+                break
+            yield page
+
+        worker.join()
+
+
+
+def bs4_strings(html):
     """
+    Text pieces of a page in document order using BeautifulSoup's html.parser (slowest, always available).
 
-    # parse html content of the website with beautiful soup
+    Input: HTML
+    Output: generator of text pieces
+    """
     soup = BeautifulSoup(html, 'html.parser')
 
-    # extract plain text from html
-    text = soup.get_text()
-    
-    # remove extra white space in the text using regex
-    processed_text = re.sub('\s+', ' ', text)
+    # drop scripts, styles and navigation before walking the text
+    for tag in soup(SKIPPED_TAGS):
+        tag.decompose()
+
+    return soup.strings
+
+
+def lxml_strings(html):
+    """
+    Text pieces of a page in document order using lxml's C parser.
+
+    Input: HTML
+    Output: generator of text pieces
+    """
+    # an empty body has no text; lxml would raise "Document is empty" where the other backends yield nothing
+    if not html.strip():
+        return
+
+    try:
+        try:
+            root = lxml.html.document_fromstring(html)
+        except ValueError:
+            # lxml refuses str input that carries an XML encoding declaration
+            root = lxml.html.document_fromstring(html.encode('utf-8'))
+    except (lxml.etree.ParserError, lxml.etree.XMLSyntaxError):
+        # nothing lxml can build a document from (e.g. only comments); no text, like the other backends
+        return
+
+    skipped = set(SKIPPED_TAGS)
+
+    # Depth first walk with an explicit stack; plain strings on the stack are tails waiting for their turn
+    stack = [root]
+    while stack:
+        element = stack.pop()
+        if isinstance(element, str):
+            yield element
+            continue
+
+        # the tail follows the closing tag, so it is emitted after the children (and even for skipped tags)
+        if element.tail and element is not root:
+            stack.append(element.tail)
 
-    #cut the text to 10000 characters
-    if len(processed_text) > 10000:
-        print(f"        Trimming webpage content from {len(processed_text)} to 10000 characters")
-        processed_text = processed_text[:10000]
+        # comments and processing instructions have a non-string tag; only their tail is page text
+        if not isinstance(element.tag, str) or element.tag in skipped:
+            continue
+
+        if element.text:
+            yield element.text
+        stack.extend(reversed(element))
+
+
+def selectolax_strings(html):
+    """
+    Text pieces of a page in document order using selectolax (lexbor), the fastest backend.
+
+    Input: HTML
+    Output: generator of text pieces
+    """
+    tree = HTMLParser(html)
+    tree.strip_tags(SKIPPED_TAGS)
+
+    if tree.root is None:
+        return
+    for node in tree.root.traverse(include_text=True):
+        if node.tag == '-text':
+            yield node.text_content
+
+
+# HTML to text backends in order of preference for "auto"
+TEXT_BACKENDS = {
+    "selectolax": selectolax_strings,
+    "lxml": lxml_strings,
+    "bs4": bs4_strings,
+}
+
+
+def get_text_backend(name=None):
+    """
+    Resolve a backend name to its text function, skipping backends whose parser is not installed.
+
+    Input: backend name ("auto", "selectolax", "lxml", "bs4"); defaults to text_backend
+    Output: function taking HTML and returning text pieces
+    """
+    name = name or text_backend
+    available = {
+        "selectolax": HTMLParser is not None,
+        "lxml": lxml is not None,
+        "bs4": True,
+    }
+
+    if name == "auto":
+        name = next(backend for backend in TEXT_BACKENDS if available[backend])
+    if name not in TEXT_BACKENDS:
+        raise ValueError(f"Unknown text backend '{name}'. Choose one of: auto, {', '.join(TEXT_BACKENDS)}")
+    if not available[name]:
+        raise ValueError(f"Text backend '{name}' is not installed.")
+
+    return TEXT_BACKENDS[name]
+
+
+def main_content_strings(html):
+    """
+    Text pieces of the main article body of a page, found with a readability-style content density score.
+
+    Every paragraph-like block is scored by its length and number of commas; the score is credited to its
+    parent and (half) to its grandparent. Containers are penalised by their link density, the best one wins,
+    and its siblings that score well enough are kept with it. Menus, cookie banners, footers and other
+    boilerplate are removed first.
+
+    Input: HTML
+    Output: list of text pieces, or None if no convincing main content was found
+    """
+    soup = BeautifulSoup(html, 'lxml' if lxml is not None else 'html.parser')
+
+    # drop scripts, styles, navigation and other boilerplate tags
+    for tag in soup(SKIPPED_TAGS + BOILERPLATE_TAGS):
+        tag.decompose()
+
+    # drop elements whose class/id looks like boilerplate (cookie banners, share bars, ...)
+    for tag in soup.find_all(True):
+        if tag.decomposed or tag.attrs is None or tag.name in ("html", "body"):
+            continue
+        hint = " ".join(tag.get("class", [])) + " " + (tag.get("id") or "")
+        if UNLIKELY_CANDIDATES.search(hint) and not LIKELY_CANDIDATES.search(hint):
+            tag.decompose()
+
+    def text_of(node):
+        return WHITESPACE.sub(' ', node.get_text()).strip()
+
+    def link_density(node, text_length):
+        link_length = sum(len(text_of(a)) for a in node.find_all("a"))
+        return link_length / text_length if text_length else 1.0
+
+    # score paragraph-like blocks and credit their ancestors
+    scores = {}
+    nodes = {}
+    for block in soup.find_all(["p", "pre", "td", "blockquote", "div"]):
+        # a div only counts as a paragraph when it holds no other blocks
+        if block.name == "div" and block.find(BLOCK_TAGS):
+            continue
+        text = text_of(block)
+        if len(text) < 25:
+            continue
+
+        score = 1 + text.count(',') + min(len(text) // 100, 3)
+        for ancestor, share in ((block.parent, 1.0), (block.parent.parent if block.parent else None, 0.5)):
+            if ancestor is None or ancestor.name is None or ancestor.name == "[document]":
+                continue
+            scores[id(ancestor)] = scores.get(id(ancestor), 0) + score * share
+            nodes[id(ancestor)] = ancestor
+
+    if not scores:
+        return None
+
+    # penalise containers that are mostly links
+    for key, node in nodes.items():
+        scores[key] *= 1 - link_density(node, len(text_of(node)))
+
+    top_key = max(scores, key=scores.get)
+    top = nodes[top_key]
+    threshold = max(10, scores[top_key] * 0.2)
+
+    # keep the top container together with siblings that also look like content
+    kept = []
+    for sibling in (top.parent.children if top.parent is not None else [top]):
+        if sibling is top or (id(sibling) in scores and scores[id(sibling)] >= threshold):
+            kept.append(sibling)
+
+    pieces = [piece for node in kept for piece in node.strings]
+    if len(WHITESPACE.sub(' ', ''.join(pieces)).strip()) < min_main_content_chars:
+        return None
+    return pieces
+
+
+def extract_plain_text(html, max_chars=None, backend=None, main_content=None, verbose=True):
+    """
+    Extract plain text from HTML
+
+    Text is collected string by string, skipping scripts, styles and navigation, with whitespace collapsed
+    in the same pass. Extraction stops as soon as the character budget is filled, so the rest of the page
+    is never walked. All backends produce the same text up to differences in how their parsers repair broken HTML.
+
+    With main_content, only the article body found by main_content_strings() is kept, so the budget is not spent
+    on menus and footers. Pages without a convincing article body fall back to the whole page text.
+
+    Input: HTML (fetched from fetch_website), character budget (defaults to max_text_chars), backend name (defaults to text_backend),
+           main content flag (defaults to extract_main_content), verbose flag to print trimming to the terminal
+    Output: Plain text
+    """
+    processed_text, trimmed = extract_plain_text_trimmed(html, max_chars, backend, main_content)
+
+    #cut the text to the character budget
+    if trimmed and verbose:
+        print(f"        Trimming webpage content to {max_chars if max_chars is not None else max_text_chars} characters")
 
     # Return processed plain text
-    return processed_text
\ No newline at end of file
+    return processed_text
+
+
+def extract_plain_text_trimmed(html, max_chars=None, backend=None, main_content=None):
+    """
+    Same as extract_plain_text(), also telling whether the text was cut at the character budget (a page of
+    exactly max_chars characters is not).
+
+    Input: HTML, character budget (defaults to max_text_chars), backend name (defaults to text_backend),
+           main content flag (defaults to extract_main_content)
+    Output: (plain text, True if the text was cut)
+    """
+    if max_chars is None:
+        max_chars = max_text_chars
+    if main_content is None:
+        main_content = extract_main_content
+
+    # an empty (or whitespace only) body has no text, whichever backend would parse it
+    if not html.strip():
+        return '', False
+
+    # parse html content of the website, keeping only the article body if asked to
+    strings = main_content_strings(html) if main_content else None
+    if strings is None:
+        strings = get_text_backend(backend)(html)
+
+    # extract plain text from html, removing extra white space as we go, until the budget is filled
+    return collapse_whitespace(strings, max_chars)
+
+
+def collapse_whitespace(pieces, max_chars):
+    """
+    Join text pieces while collapsing every run of whitespace to a single space (like re.sub(r'\\s+', ' ')
+    over the joined text), stopping once more than max_chars characters have been produced.
+
+    Input: iterable of text pieces in document order, character budget
+    Output: (text cut to max_chars, True if text was cut)
+    """
+    out = []
+    length = 0
+    ends_with_space = False
+
+    for piece in pieces:
+        piece = WHITESPACE.sub(' ', piece)
+
+        # A whitespace run can span two pieces; only keep one space for it
+        if ends_with_space and piece.startswith(' '):
+            piece = piece[1:]
+        if not piece:
+            continue
+
+        out.append(piece)
+        length += len(piece)
+        ends_with_space = piece.endswith(' ')
+
+        if length > max_chars:
+            return ''.join(out)[:max_chars], True
+
+    return ''.join(out), False